@@ -1,15 +1,40 @@
+import time
+
+# Отсчёт холодного старта ведётся до импорта aiogram — он занимает большую часть запуска
+STARTED_AT = time.monotonic()
+
 import asyncio
+import bisect
+import inspect
 import logging
 import sqlite3
 import os
 import json
-import requests
+import multiprocessing
+import csv
+import tempfile
+import aiohttp
+from aiohttp import web
 import re
+import secrets
+import signal
+import threading
+from dataclasses import dataclass, fields
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandStart
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from decimal import Context, Decimal, DivisionByZero, InvalidOperation, Overflow
+from functools import lru_cache, partial
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ChatMemberStatus
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -19,7 +44,8 @@ CRYPTOBOT_TOKEN = os.environ.get("CRYPTOBOT_TOKEN", "")
 # Настройки
 CARD_NUMBER = "2200700527205453"
 STAR_RATE = 1.5
-USD_RATE = 85.0
+# Курс USD/RUB до первого успешного запроса к CryptoBot (нет сохранённого курса в БД и нет токена)
+USD_RATE = float(os.environ.get("USD_RATE", 85.0))
 
 PREMIUM_PRICES = {
     "3m": {"rub": 1124.11, "name": "3 месяца"},
@@ -33,56 +59,330 @@ SUPPORT_USER = "Voidovi"
 CHANNEL_ID = -1003632929882
 CHANNEL_USERNAME = "NewsDigistars"
 
+# Получение апдейтов: если задан WEBHOOK_URL (публичный https-адрес) — webhook, иначе long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token; без переменной генерируется на каждый запуск
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", 8080))
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.environ.get("WEBHOOK_SHUTDOWN_TIMEOUT", 30))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+# Несколько процессов-воркеров принимают вебхук на одном порту (SO_REUSEPORT) и делят
+# БД и состояния диалогов. Воркер 0 — ведущий: ставит вебхук и сверяет счета CryptoBot
+WORKERS = max(1, int(os.environ.get("WORKERS", 1)))
+WORKER_ID = int(os.environ.get("WORKER_ID", 0))
+IS_LEADER = WORKER_ID == 0
+
+# Очередь уведомлений: лимиты Telegram ~30 сообщений/сек всего и ~1/сек в один чат
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 4))
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", 25))
+NOTIFY_CHAT_RATE = float(os.environ.get("NOTIFY_CHAT_RATE", 1))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 5))
+
+# Кэш проверки подписки (секунды / количество пользователей)
+SUBSCRIPTION_CACHE_TTL = float(os.environ.get("SUBSCRIPTION_CACHE_TTL", 300))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.environ.get("SUBSCRIPTION_NEGATIVE_TTL", 30))
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get("SUBSCRIPTION_CACHE_SIZE", 10000))
+
+# База данных
+DB_PATH = os.environ.get("DB_PATH", "digistore.db")
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", 4))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16384))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 64 * 1024 * 1024))
+ORDERS_PAGE_SIZE = 10
+
+# Состояния диалогов: "sqlite" (общий файл БД, переживает рестарт) или "memory"
+STATE_STORAGE = os.environ.get("STATE_STORAGE", "sqlite")
+STATE_TTL = float(os.environ.get("STATE_TTL", 24 * 3600))
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", 50000))
+
+# Сетевые настройки CryptoBot
+# Адрес Crypto Pay API: для тестовой сети или фейкового сервера нагрузочного теста
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api").rstrip("/")
+CRYPTOBOT_TIMEOUT = float(os.environ.get("CRYPTOBOT_TIMEOUT", 10))
+CRYPTOBOT_MAX_CONNECTIONS = int(os.environ.get("CRYPTOBOT_MAX_CONNECTIONS", 10))
+CRYPTO_POLL_INTERVAL = float(os.environ.get("CRYPTO_POLL_INTERVAL", 30))
+# Курс из getExchangeRates считается свежим столько секунд; устаревший отдаётся сразу и обновляется в фоне
+RATE_TTL = float(os.environ.get("RATE_TTL", 300))
+# Срок жизни счёта CryptoBot. Повторное нажатие «CryptoBot» отдаёт тот же счёт, пока он не истёк;
+# неоплаченный заказ с истёкшим счётом отменяется (т.е. через INVOICE_TTL после выставления) —
+# фоновой сверкой или первым же нажатием после истечения, новый счёт для него не выставляется
+INVOICE_TTL = int(os.environ.get("INVOICE_TTL", 24 * 3600))
+
+# Ограничение частоты; при 0 middleware не подключается (например, в нагрузочном тесте)
+THROTTLE_ENABLED = os.environ.get("THROTTLE_ENABLED", "1") == "1"
+# (токенов в секунду, размер пачки) на пользователя для каждого класса действий
+THROTTLE_RATES = {
+    "navigation": (1.0, 5),
+    "input": (1.0, 5),
+}
+# Повтор того же колбэка в этом окне (секунды) — двойное нажатие, отбрасывается молча
+THROTTLE_DUPLICATE_WINDOW = float(os.environ.get("THROTTLE_DUPLICATE_WINDOW", 1.0))
+# При стольких одновременно обрабатываемых апдейтах навигация отбрасывается (режим перегрузки)
+THROTTLE_OVERLOAD_INFLIGHT = int(os.environ.get("THROTTLE_OVERLOAD_INFLIGHT", 200))
+
+# Очередь апдейтов одного пользователя: апдейты сверх лимита отбрасываются
+USER_LANE_MAX_DEPTH = int(os.environ.get("USER_LANE_MAX_DEPTH", 5))
+
+# Метрики задержек (/metrics и экран «🤖 Бот»); при 0 обёртки и middleware не подключаются вовсе
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# Порт отдельного сервера /metrics в режиме polling (в режиме webhook /metrics на WEBAPP_PORT)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# ========== МЕТРИКИ ==========
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# callback_data присылает клиент — ограничиваем число рядов, чтобы мусорные данные не раздували память
+METRICS_MAX_SERIES = 200
+
+class LatencySeries:
+    __slots__ = ("count", "errors", "total", "max", "buckets")
+    
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    
+    def quantile(self, q):
+        """Оценка квантиля по гистограмме — верхняя граница корзины"""
+        rank = q * self.count
+        seen = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return self.max
+
+class Metrics:
+    """Гистограммы задержек по видам: handler, telegram, cryptobot, db"""
+    
+    KINDS = {
+        "handler": ("digistore_handler_seconds", "handler", "Время обработки апдейта"),
+        "telegram": ("digistore_telegram_request_seconds", "method", "Запросы к Telegram Bot API"),
+        "cryptobot": ("digistore_cryptobot_request_seconds", "method", "Запросы к Crypto Pay API"),
+        "db": ("digistore_db_query_seconds", "query", "Запросы к базе данных"),
+    }
+    
+    def __init__(self):
+        self.series = {kind: {} for kind in self.KINDS}
+    
+    def observe(self, kind, name, seconds, error=False):
+        series = self.series[kind].get(name)
+        if series is None:
+            if len(self.series[kind]) >= METRICS_MAX_SERIES:
+                name = "other"
+                series = self.series[kind].get(name)
+            if series is None:
+                series = self.series[kind][name] = LatencySeries()
+        series.observe(seconds, error)
+    
+    def timed(self, kind, name, coroutine_function):
+        """Обёртка корутины с замером времени"""
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = True
+            try:
+                result = await coroutine_function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.observe(kind, name, time.perf_counter() - started, error)
+        return wrapper
+    
+    def summary(self, kind, limit=5):
+        """Самые медленные по p95: [(имя, count, avg_ms, p95_ms)]"""
+        rows = [
+            (name, series.count, series.total / series.count * 1000, series.quantile(0.95) * 1000)
+            for name, series in self.series[kind].items() if series.count
+        ]
+        rows.sort(key=lambda row: (row[3], row[2]), reverse=True)
+        return rows[:limit]
+    
+    def totals(self, kind):
+        count = sum(series.count for series in self.series[kind].values())
+        total = sum(series.total for series in self.series[kind].values())
+        errors = sum(series.errors for series in self.series[kind].values())
+        return count, (total / count * 1000 if count else 0.0), errors
+    
+    def render(self, extra=None):
+        """Текст в формате Prometheus exposition"""
+        lines = []
+        for kind, (metric, label, description) in self.KINDS.items():
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, series in sorted(self.series[kind].items()):
+                labels = f'{label}="{name}"'
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, series.buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {series.count}')
+                lines.append(f"{metric}_sum{{{labels}}} {series.total:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {series.count}")
+            errors_metric = metric.replace("_seconds", "_errors_total")
+            lines.append(f"# TYPE {errors_metric} counter")
+            for name, series in sorted(self.series[kind].items()):
+                lines.append(f'{errors_metric}{{{label}="{name}"}} {series.errors}')
+        for name, value in (extra or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics() if METRICS_ENABLED else None
+
+def update_label(update: types.Update):
+    """Имя хендлера для метрик: действие колбэка, команда или тип сообщения"""
+    if update.callback_query:
+        route = callback_route(update.callback_query.data)
+        return route.action if route is not None else "invalid"
+    if update.message:
+        text = update.message.text or ""
+        if text.startswith("/"):
+            return "/" + re.sub(r"\W", "", text.split()[0].split("@")[0])[:40]
+        return "photo" if update.message.photo else "text"
+    return update.event_type
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Полное время обработки апдейта, включая остальные middleware"""
+    
+    def __init__(self, metrics):
+        self.metrics = metrics
+    
+    async def __call__(self, handler, event: types.Update, data):
+        started = time.perf_counter()
+        error = True
+        try:
+            result = await handler(event, data)
+            error = False
+            return result
+        finally:
+            self.metrics.observe("handler", update_label(event), time.perf_counter() - started, error)
+
+class BotRequestMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, metrics):
+        self.metrics = metrics
+    
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        error = True
+        try:
+            result = await make_request(bot, method)
+            error = False
+            return result
+        finally:
+            self.metrics.observe("telegram", method.__api_method__, time.perf_counter() - started, error)
+
 # ========== CRYPTOBOT ==========
 class CryptoBotAPI:
-    def __init__(self, token):
+    def __init__(self, token, timeout=CRYPTOBOT_TIMEOUT, max_connections=CRYPTOBOT_MAX_CONNECTIONS, base_url=CRYPTOBOT_API_URL):
         self.token = token
-        self.base_url = "https://pay.crypt.bot/api"
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_connections = max_connections
+        self.session = None
+        # Ограничиваем число одновременных запросов к API, чтобы всплеск оплат не открывал сотни соединений
+        self._semaphore = asyncio.Semaphore(max_connections)
+    
+    async def start(self):
+        """Открывает общую сессию с пулом keep-alive соединений"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Crypto-Pay-API-Token": self.token}
+            )
+    
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
     
-    async def create_invoice(self, amount, description=""):
+    async def _request(self, http_method, api_method, params=None, data=None, timeout=None):
+        if self.session is None or self.session.closed:
+            await self.start()
+        
+        url = f"{self.base_url}/{api_method}"
+        request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        
+        started = time.perf_counter() if metrics else 0.0
+        error = True
+        try:
+            async with self._semaphore:
+                async with self.session.request(
+                    http_method, url, params=params, json=data, timeout=request_timeout
+                ) as response:
+                    result = await response.json(content_type=None)
+                    error = not result.get("ok", False)
+                    return result
+        finally:
+            if metrics:
+                metrics.observe("cryptobot", api_method, time.perf_counter() - started, error)
+    
+    async def create_invoice(self, amount_usdt, description="", payload="", expires_in=INVOICE_TTL, timeout=None):
         try:
-            url = f"{self.base_url}/createInvoice"
-            headers = {"Crypto-Pay-API-Token": self.token}
-            
-            amount_usdt = amount / 85.0
-            
             data = {
                 "asset": "USDT",
                 "amount": str(round(amount_usdt, 2)),
                 "description": description[:1024],
                 "paid_btn_name": "openBot",
                 "paid_btn_url": "https://t.me/DigiStoreBot",
-                "payload": f"order_{int(datetime.now().timestamp())}",
-                "allow_anonymous": False
+                "payload": payload,
+                "allow_anonymous": False,
+                "expires_in": expires_in
             }
             
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            result = response.json()
+            result = await self._request("POST", "createInvoice", data=data, timeout=timeout)
             
             if result.get("ok"):
                 invoice = result["result"]
+                # Время после ответа не раньше реального истечения счёта
+                expires_at = time.time() + expires_in
+                if invoice.get("expiration_date"):
+                    expires_at = max(expires_at, datetime.fromisoformat(invoice["expiration_date"]).timestamp())
                 return {
                     "success": True,
                     "invoice_id": invoice["invoice_id"],
                     "pay_url": invoice["pay_url"],
                     "amount": invoice["amount"],
-                    "asset": invoice["asset"]
+                    "asset": invoice["asset"],
+                    "expires_at": expires_at
                 }
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
                 
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    async def check_invoice_status(self, invoice_id):
+    async def delete_invoice(self, invoice_id, timeout=None):
+        """Удаляет счёт, чтобы его больше нельзя было оплатить; True при успехе"""
         try:
-            url = f"{self.base_url}/getInvoices"
-            headers = {"Crypto-Pay-API-Token": self.token}
-            
-            params = {"invoice_ids": invoice_id}
+            result = await self._request("POST", "deleteInvoice", data={"invoice_id": int(invoice_id)}, timeout=timeout)
+            return bool(result.get("ok"))
+        except Exception:
+            return False
+    
+    async def check_invoice_status(self, invoice_id, timeout=None):
+        try:
+            params = {"invoice_ids": str(invoice_id)}
             
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            result = response.json()
+            result = await self._request("GET", "getInvoices", params=params, timeout=timeout)
             
             if result.get("ok"):
                 invoice = result["result"]["items"][0]
@@ -95,28 +395,151 @@ class CryptoBotAPI:
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
                 
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
+    
+    async def get_exchange_rates(self, timeout=None):
+        """Курсы {(source, target): rate}, например ("USDT", "RUB")"""
+        result = await self._request("GET", "getExchangeRates", timeout=timeout)
+        if not result.get("ok"):
+            raise RuntimeError(result.get("error", {}).get("name", "Unknown error"))
+        return {
+            (item["source"], item["target"]): float(item["rate"])
+            for item in result["result"] if item.get("is_valid")
+        }
+    
+    async def get_invoices(self, invoice_ids, batch_size=100, timeout=None):
+        """Статусы сразу нескольких счетов: {invoice_id: invoice} одним запросом на пачку"""
+        invoices = {}
+        invoice_ids = [str(invoice_id) for invoice_id in invoice_ids]
+        
+        for i in range(0, len(invoice_ids), batch_size):
+            batch = invoice_ids[i:i + batch_size]
+            params = {"invoice_ids": ",".join(batch), "count": len(batch)}
+            
+            result = await self._request("GET", "getInvoices", params=params, timeout=timeout)
+            
+            if not result.get("ok"):
+                raise RuntimeError(result.get("error", {}).get("name", "Unknown error"))
+            
+            for invoice in result["result"]["items"]:
+                invoices[str(invoice["invoice_id"])] = invoice
+        
+        return invoices
 
-cryptobot = CryptoBotAPI(CRYPTOBOT_TOKEN) if CRYPTOBOT_TOKEN else None
 
-# ========== БАЗА ДАННЫХ ==========
-class Database:
-    def __init__(self, db_name="digistore.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
+# ========== КУРСЫ ВАЛЮТ ==========
+class RateService:
+    """Курсы из getExchangeRates CryptoBot с кэшем в памяти.
+    
+    Чтение курса не ходит в сеть: устаревший курс (старше ttl) отдаётся сразу,
+    а обновление запускается в фоне одной задачей. Последний удачный снимок
+    сохраняется в БД и загружается при старте; без него используется USD_RATE.
+    """
+    
+    def __init__(self, cryptobot, database, ttl=RATE_TTL, fallback=USD_RATE, retry_interval=30):
+        self.cryptobot = cryptobot
+        self.db = database
+        self.ttl = ttl
+        self.fallback = fallback
+        self.retry_interval = retry_interval
+        self._retry_at = 0.0
+        self.rates = {}
+        self.updated_at = None
+        self.refreshes = 0
+        self.failures = 0
+        self._refresh_task = None
+    
+    async def load(self):
+        self.rates, self.updated_at = await self.db.get_exchange_rates()
+        self._refresh_if_stale()
+    
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+    
+    def age(self):
+        return time.time() - self.updated_at if self.updated_at is not None else None
+    
+    def _refresh_if_stale(self):
+        if self.cryptobot is None or (self._refresh_task is not None and not self._refresh_task.done()):
+            return
+        if time.monotonic() < self._retry_at:
+            return
+        age = self.age()
+        if age is None or age >= self.ttl:
+            self._refresh_task = asyncio.create_task(self.refresh())
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    async def refresh(self):
+        try:
+            rates = await self.cryptobot.get_exchange_rates(timeout=CRYPTOBOT_TIMEOUT)
+        except Exception as e:
+            # Старый курс продолжает работать; следующая попытка — не раньше retry_interval
+            self.failures += 1
+            self._retry_at = time.monotonic() + self.retry_interval
+            logger.warning("Не удалось обновить курсы CryptoBot: %s", e)
+            return
         
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+        updated_at = time.time()
+        self.rates = {**self.rates, **rates}
+        self.updated_at = updated_at
+        self.refreshes += 1
+        try:
+            await self.db.save_exchange_rates(rates, updated_at)
+        except Exception as e:
+            logger.warning("Не удалось сохранить курсы: %s", e)
+    
+    def rate(self, source, target, default=None):
+        self._refresh_if_stale()
+        return self.rates.get((source, target), default)
+    
+    def usd_rub(self):
+        """Курс USD/RUB для обмена и счетов (USDT привязан к доллару)"""
+        return self.rate("USDT", "RUB", self.fallback)
+    
+    def rub_to_usdt(self, amount_rub):
+        return amount_rub / self.usd_rub()
+    
+    def stats(self):
+        return {
+            "usd_rub": self.rates.get(("USDT", "RUB"), self.fallback),
+            "age": self.age(),
+            "refreshes": self.refreshes,
+            "failures": self.failures
+        }
+
+# ========== БАЗА ДАННЫХ ==========
+# Статусы, которые считаются «активным заказом» и «выручкой». В запросах передаются параметрами;
+# в уже применённых миграциях списки записаны буквально, чтобы их SQL не менялся вместе с константами
+ACTIVE_STATUSES = ("pending", "waiting_payment", "waiting_confirmation", "waiting_crypto", "confirmed")
+
+# Допустимые переходы статусов заказа; всё, что не описано здесь, отклоняется
+ORDER_TRANSITIONS = {
+    # confirmed из pending/waiting_payment — ручное подтверждение админом (оплата без фото в боте)
+    "pending": ("waiting_payment", "waiting_crypto", "confirmed", "cancelled"),
+    # Пользователь может сменить способ оплаты, пока не отправил фото или не оплатил счёт
+    "waiting_payment": ("waiting_confirmation", "waiting_crypto", "confirmed", "cancelled"),
+    "waiting_crypto": ("confirmed", "waiting_payment", "cancelled"),
+    "waiting_confirmation": ("confirmed", "cancelled"),
+    "confirmed": ("completed", "cancelled"),
+    "completed": (),
+    "cancelled": (),
+}
+PAID_STATUSES = ("confirmed", "completed")
+
+# Миграции схемы по порядку: (версия, SQL). Новые изменения — только новой записью в конец
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             full_name TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS orders (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             order_type TEXT,
@@ -127,115 +550,835 @@ class Database:
             status TEXT DEFAULT 'pending',
             invoice_id TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
+        )''',
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+        # Покрывающие индексы: выручка и активные за 24ч считаются без чтения строк таблицы
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_amount ON orders(status, amount_rub)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_created_user ON orders(created_at, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_invoice_id ON orders(invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    ]),
+    (3, [
+        # Счётчики статистики: общие итоги и корзины по дням, обновляются вместе с данными
+        '''CREATE TABLE IF NOT EXISTS stats_totals (
+            key TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, key)
+        ) WITHOUT ROWID''',
+        # Одна строка на пользователя с временем последнего заказа — окно «активных за 24ч»
+        '''CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            last_order_at TIMESTAMP NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_last ON user_activity(last_order_at)",
+        "INSERT OR REPLACE INTO stats_totals (key, value) SELECT 'users', COUNT(*) FROM users",
+        "INSERT OR REPLACE INTO stats_totals (key, value) SELECT 'orders', COUNT(*) FROM orders",
+        "INSERT OR REPLACE INTO stats_totals (key, value) SELECT 'active_orders', COUNT(*) FROM orders "
+        "WHERE status IN ('pending', 'waiting_payment', 'waiting_confirmation', 'waiting_crypto', 'confirmed')",
+        "INSERT OR REPLACE INTO stats_totals (key, value) SELECT 'revenue', COALESCE(SUM(amount_rub), 0) FROM orders "
+        "WHERE status IN ('confirmed', 'completed')",
+        "INSERT OR REPLACE INTO stats_daily (day, key, value) SELECT DATE(created_at), 'users', COUNT(*) FROM users GROUP BY DATE(created_at)",
+        "INSERT OR REPLACE INTO stats_daily (day, key, value) SELECT DATE(created_at), 'orders', COUNT(*) FROM orders GROUP BY DATE(created_at)",
+        "INSERT OR REPLACE INTO stats_daily (day, key, value) SELECT DATE(created_at), 'revenue', SUM(amount_rub) FROM orders "
+        "WHERE status IN ('confirmed', 'completed') GROUP BY DATE(created_at)",
+        "INSERT OR REPLACE INTO user_activity (user_id, last_order_at) SELECT user_id, MAX(created_at) FROM orders GROUP BY user_id",
+    ]),
+    (4, [
+        # Фильтр по типу заказа в админке с сортировкой по дате
+        "CREATE INDEX IF NOT EXISTS idx_orders_type_status_created ON orders(order_type, status, created_at)",
+    ]),
+    (5, [
+        # Состояния диалогов пользователей (см. SQLiteStateStorage)
+        '''CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states(expires_at)",
+    ]),
+    (6, [
+        # Детали заказа — отдельные колонки вместо JSON в details (колонка details больше не пишется)
+        "ALTER TABLE orders ADD COLUMN stars INTEGER",
+        "ALTER TABLE orders ADD COLUMN period TEXT",
+        "ALTER TABLE orders ADD COLUMN amount_usd REAL",
+        "ALTER TABLE orders ADD COLUMN exchange_rate REAL",
+        "ALTER TABLE orders ADD COLUMN payment_photo TEXT",
+        '''UPDATE orders SET
+            stars = json_extract(details, '$.stars'),
+            period = json_extract(details, '$.period'),
+            amount_usd = json_extract(details, '$.amount_usd'),
+            exchange_rate = json_extract(details, '$.exchange_rate'),
+            payment_photo = json_extract(details, '$.payment_photo')
+        WHERE json_valid(details)''',
+        # Старые заказы обмена без суммы в USD считались по курсу 85.0
+        '''UPDATE orders SET exchange_rate = COALESCE(exchange_rate, 85.0),
+            amount_usd = amount_rub / COALESCE(exchange_rate, 85.0)
+        WHERE order_type = 'exchange' AND amount_usd IS NULL''',
+    ]),
+    (7, [
+        '''CREATE TABLE IF NOT EXISTS order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            actor TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events(order_id, id)",
+    ]),
+    (8, [
+        # Последние полученные курсы: после рестарта доступны без запроса к CryptoBot
+        '''CREATE TABLE IF NOT EXISTS exchange_rates (
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            rate REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (source, target)
+        ) WITHOUT ROWID''',
+    ]),
+    (9, [
+        # Выставленный счёт CryptoBot: повторное нажатие отдаёт его без запроса к API
+        "ALTER TABLE orders ADD COLUMN invoice_url TEXT",
+        "ALTER TABLE orders ADD COLUMN invoice_amount TEXT",
+        "ALTER TABLE orders ADD COLUMN invoice_expires_at REAL",
+    ]),
+    (10, [
+        # Выручку, заказы и активных за 24ч считают счётчики из v3 — индексы под прежние запросы
+        # только замедляют каждую запись в orders и users
+        "DROP INDEX IF EXISTS idx_orders_status_amount",
+        "DROP INDEX IF EXISTS idx_orders_created_user",
+        "DROP INDEX IF EXISTS idx_users_created_at",
+    ]),
+]
+
+@dataclass(slots=True)
+class Order:
+    id: int
+    user_id: int
+    order_type: str
+    recipient: str
+    amount_rub: float
+    payment_method: str
+    status: str
+    invoice_id: str = None
+    created_at: str = None
+    stars: int = None
+    period: str = None
+    amount_usd: float = None
+    exchange_rate: float = None
+    payment_photo: str = None
+    invoice_url: str = None
+    invoice_amount: str = None
+    invoice_expires_at: float = None
+
+ORDER_COLUMNS = tuple(field.name for field in fields(Order))
+ORDER_SELECT = f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders"
+
+class Database:
+    """Асинхронный доступ к SQLite: все записи идут через один поток-писатель,
+    чтения — через небольшой пул потоков со своими соединениями, так что
+    fsync и медленные запросы не блокируют event loop"""
+    
+    def __init__(self, db_name=DB_PATH, read_pool_size=DB_READ_POOL_SIZE):
+        self.db_name = db_name
+        self.schema_version = 0
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="db-reader")
+        self._writer.submit(self.migrate).result()
+        if metrics:
+            self._instrument(metrics)
+    
+    def _instrument(self, metrics):
+        """Оборачивает публичные async-методы замером времени (вместе с ожиданием в пуле потоков)"""
+        for name, method in inspect.getmembers(self, inspect.iscoroutinefunction):
+            if not name.startswith("_"):
+                setattr(self, name, metrics.timed("db", name, method))
+    
+    def _connection(self, readonly=False):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+            conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            if readonly:
+                conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def migrate(self):
+        """Применяет недостающие миграции; версия схемы хранится в PRAGMA user_version"""
+        conn = self._connection()
+        # WAL сохраняется в файле БД: читатели не блокируют писателя и наоборот
+        conn.execute("PRAGMA journal_mode = WAL")
+        
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        for migration_version, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Воркеры стартуют одновременно: пока ждали блокировку, миграцию мог применить другой процесс
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if migration_version <= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {migration_version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            
+            version = migration_version
+            logger.info(f"БД: применена миграция схемы v{migration_version}")
         
-        self.conn.commit()
+        self.schema_version = version
     
-    def add_user(self, user_id, username, full_name):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
-            (user_id, username, full_name)
+    def close(self):
+        try:
+            # Обновляет статистику планировщика для индексов перед остановкой
+            self._writer.submit(lambda: self._connection().execute("PRAGMA optimize")).result()
+        except Exception as e:
+            logger.warning(f"БД: PRAGMA optimize не выполнен: {e}")
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+    
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, fn, *args)
+    
+    async def _write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, fn, *args)
+    
+    async def _fetchone(self, query, params=()):
+        def run():
+            return self._connection(readonly=True).execute(query, params).fetchone()
+        return await self._read(run)
+    
+    async def _fetchall(self, query, params=()):
+        def run():
+            return self._connection(readonly=True).execute(query, params).fetchall()
+        return await self._read(run)
+    
+    async def _execute(self, query, params=()):
+        """Одна запись с коммитом; возвращает курсор (lastrowid / rowcount)"""
+        def run():
+            conn = self._connection()
+            cursor = conn.execute(query, params)
+            conn.commit()
+            return cursor
+        return await self._write(run)
+    
+    async def _transaction(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке-писателе одной транзакцией"""
+        def run():
+            conn = self._connection()
+            # IMMEDIATE сразу берёт блокировку записи: чтение и обновление внутри fn атомарны
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+        return await self._write(run)
+    
+    @staticmethod
+    def _bump(conn, key, delta, day=None):
+        if not delta:
+            return
+        conn.execute(
+            "INSERT INTO stats_totals (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            (key, delta)
         )
-        self.conn.commit()
-    
-    def add_order(self, user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id=None):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """INSERT INTO orders 
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id)
+        if day:
+            conn.execute(
+                "INSERT INTO stats_daily (day, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, key) DO UPDATE SET value = value + excluded.value",
+                (day, key, delta)
+            )
+    
+    def _set_status(self, conn, order_id, status, expected_status=None, actor=None):
+        """Переводит заказ в status, если это разрешено ORDER_TRANSITIONS и текущий статус
+        входит в expected_status (строка или кортеж). Возвращает False, если перехода не было —
+        побочные эффекты (уведомления) выполняются только при True"""
+        if isinstance(expected_status, str):
+            expected_status = (expected_status,)
+        row = conn.execute(
+            "SELECT status, amount_rub, DATE(created_at) FROM orders WHERE id = ?",
+            (order_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        
+        old_status, amount_rub, day = row
+        if status not in ORDER_TRANSITIONS.get(old_status, ()):
+            return False
+        if expected_status is not None and old_status not in expected_status:
+            return False
+        
+        # Compare-and-set: строка обновится, только если статус не изменился с момента чтения
+        cursor = conn.execute(
+            "UPDATE orders SET status = ? WHERE id = ? AND status = ?",
+            (status, order_id, old_status)
         )
-        order_id = cursor.lastrowid
-        self.conn.commit()
-        return order_id
-    
-    def update_order_status(self, order_id, status):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET status = ? WHERE id = ?",
-            (status, order_id)
+        if cursor.rowcount == 0:
+            return False
+        conn.execute(
+            "INSERT INTO order_events (order_id, from_status, to_status, actor) VALUES (?, ?, ?, ?)",
+            (order_id, old_status, status, actor)
         )
-        self.conn.commit()
-        return cursor.rowcount > 0
+        
+        was_active, is_active = old_status in ACTIVE_STATUSES, status in ACTIVE_STATUSES
+        self._bump(conn, "active_orders", int(is_active) - int(was_active))
+        
+        # Выручка относится к дню создания заказа, как и в прежних отчётах
+        was_paid, is_paid = old_status in PAID_STATUSES, status in PAID_STATUSES
+        self._bump(conn, "revenue", (int(is_paid) - int(was_paid)) * (amount_rub or 0), day)
+        return True
     
-    def update_invoice_id(self, order_id, invoice_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET invoice_id = ? WHERE id = ?",
-            (invoice_id, order_id)
+    async def add_user(self, user_id, username, full_name):
+        def run(conn):
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
+                (user_id, username, full_name)
+            )
+            if cursor.rowcount > 0:
+                day = conn.execute("SELECT DATE(created_at) FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+                self._bump(conn, "users", 1, day)
+        await self._transaction(run)
+    
+    async def add_order(self, user_id, order_type, recipient, amount_rub, payment_method, invoice_id=None,
+                        stars=None, period=None, amount_usd=None, exchange_rate=None, state_key=None, state_data=None):
+        """С state_key заказ создаётся в одной транзакции с удалением состояния диалога и только если
+        оно всё ещё равно state_data: шаг, прочитанный двумя воркерами, даёт один заказ.
+        None — состояние уже израсходовано, заказ не создан"""
+        def run(conn):
+            if state_key is not None:
+                cursor = conn.execute(
+                    "DELETE FROM fsm_states WHERE key = ? AND data = ? AND expires_at > ?",
+                    (state_key, state_data, time.time())
+                )
+                if cursor.rowcount == 0:
+                    return None
+            cursor = conn.execute(
+                """INSERT INTO orders 
+                (user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+                 stars, period, amount_usd, exchange_rate) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+                 stars, period, amount_usd, exchange_rate)
+            )
+            order_id = cursor.lastrowid
+            day, created_at = conn.execute(
+                "SELECT DATE(created_at), created_at FROM orders WHERE id = ?", (order_id,)
+            ).fetchone()
+            self._bump(conn, "orders", 1, day)
+            self._bump(conn, "active_orders", 1)
+            conn.execute(
+                "INSERT INTO user_activity (user_id, last_order_at) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_order_at = excluded.last_order_at",
+                (user_id, created_at)
+            )
+            return order_id
+        return await self._transaction(run)
+    
+    async def update_order_status(self, order_id, status, expected_status=None, actor=None):
+        return await self._transaction(self._set_status, order_id, status, expected_status, actor)
+    
+    async def update_invoice(self, order_id, invoice_id, pay_url, amount, expires_at, previous_invoice_id=None, actor=None):
+        """Переводит заказ в waiting_crypto и сохраняет счёт одной транзакцией.
+        Заказ уже в waiting_crypto получает новый счёт, только если там всё ещё previous_invoice_id
+        или записанный счёт истёк — иначе его успело заменить параллельное нажатие.
+        False — счёт не записан"""
+        def run(conn):
+            if not self._set_status(conn, order_id, "waiting_crypto", actor=actor):
+                cursor = conn.execute(
+                    "UPDATE orders SET invoice_id = ?, invoice_url = ?, invoice_amount = ?, invoice_expires_at = ? "
+                    "WHERE id = ? AND status = 'waiting_crypto' AND (invoice_id IS ? OR invoice_expires_at < ?)",
+                    (invoice_id, pay_url, amount, expires_at, order_id, previous_invoice_id, time.time())
+                )
+                return cursor.rowcount > 0
+            conn.execute(
+                "UPDATE orders SET invoice_id = ?, invoice_url = ?, invoice_amount = ?, invoice_expires_at = ? WHERE id = ?",
+                (invoice_id, pay_url, amount, expires_at, order_id)
+            )
+            return True
+        return await self._transaction(run)
+    
+    async def clear_invoice(self, order_id, invoice_id):
+        """Забывает ссылку на удалённый счёт, чтобы её не выдали повторно; invoice_id остаётся для истории"""
+        cursor = await self._execute(
+            "UPDATE orders SET invoice_url = NULL, invoice_amount = NULL, invoice_expires_at = NULL "
+            "WHERE id = ? AND invoice_id = ?",
+            (order_id, invoice_id)
         )
-        self.conn.commit()
+        return cursor.rowcount > 0
     
-    def add_payment_photo(self, order_id, file_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET details = json_set(details, '$.payment_photo', ?) WHERE id = ?",
+    async def add_payment_photo(self, order_id, file_id):
+        cursor = await self._execute(
+            "UPDATE orders SET payment_photo = ? WHERE id = ?",
             (file_id, order_id)
         )
-        self.conn.commit()
         return cursor.rowcount > 0
     
-    def get_active_orders(self):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                SELECT id, user_id, order_type, recipient, details, amount_rub, 
-                       payment_method, status, created_at 
-                FROM orders 
-                WHERE status NOT IN ('completed', 'cancelled')
-                ORDER BY created_at DESC
-            """)
-            return cursor.fetchall()
-        except Exception as e:
-            return []
-    
-    def get_order(self, order_id):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT user_id, order_type, recipient, details, amount_rub, 
-                   payment_method, status, invoice_id, created_at 
-            FROM orders WHERE id = ?
-        """, (order_id,))
-        return cursor.fetchone()
-    
-    def get_user_orders_count(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
-        return cursor.fetchone()[0]
-    
-    def get_user_info(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT username, full_name, created_at FROM users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone()
-    
-    def get_users_count(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        return cursor.fetchone()[0]
-    
-    def get_total_orders_count(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        return cursor.fetchone()[0]
-    
-    def get_total_revenue(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT SUM(amount_rub) FROM orders WHERE status IN ('confirmed', 'completed')")
-        result = cursor.fetchone()[0]
-        return result if result else 0
+    async def get_active_orders_page(self, limit=ORDERS_PAGE_SIZE, cursor_id=0, direction="n", status=None, order_type=None):
+        """Keyset-пагинация по (created_at, id) от новых к старым.
+        direction "n" — страница после cursor_id, "p" — перед ним. Возвращает (строки, есть_ещё).
+        Без фильтра статуса страница собирается из отдельных выборок по каждому статусу: каждая идёт
+        по индексу (status, created_at) уже в нужном порядке, сортируются только их limit+1 строк"""
+        conditions, branch_params = ["status = ?"], []
+        
+        if order_type:
+            conditions.append("order_type = ?")
+            branch_params.append(order_type)
+        
+        if cursor_id:
+            comparison = "<" if direction == "n" else ">"
+            conditions.append(f"(created_at, id) {comparison} (SELECT created_at, id FROM orders WHERE id = ?)")
+            branch_params.append(cursor_id)
+        
+        sort = "DESC" if direction == "n" else "ASC"
+        branch = f"""
+            SELECT * FROM ({ORDER_SELECT}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY created_at {sort}, id {sort}
+            LIMIT ?)
+        """
+        
+        statuses = (status,) if status else ACTIVE_STATUSES
+        params = []
+        for branch_status in statuses:
+            params.extend((branch_status, *branch_params, limit + 1))
+        params.append(limit + 1)
+        
+        rows = await self._fetchall(f"""
+            {" UNION ALL ".join([branch] * len(statuses))}
+            ORDER BY created_at {sort}, id {sort}
+            LIMIT ?
+        """, tuple(params))
+        
+        has_more = len(rows) > limit
+        orders = [Order(*row) for row in rows[:limit]]
+        if direction == "p":
+            orders.reverse()
+        return orders, has_more
+    
+    async def count_active_orders(self, status=None, order_type=None):
+        conditions, params = [], []
+        
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        else:
+            conditions.append(f"status IN ({', '.join('?' * len(ACTIVE_STATUSES))})")
+            params.extend(ACTIVE_STATUSES)
+        
+        if order_type:
+            conditions.append("order_type = ?")
+            params.append(order_type)
+        
+        row = await self._fetchone(f"SELECT COUNT(*) FROM orders WHERE {' AND '.join(conditions)}", tuple(params))
+        return row[0]
+    
+    async def get_order(self, order_id):
+        row = await self._fetchone(f"{ORDER_SELECT} WHERE id = ?", (order_id,))
+        return Order(*row) if row else None
+    
+    async def get_user_orders_count(self, user_id):
+        row = await self._fetchone("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
+        return row[0]
+    
+    async def get_user_info(self, user_id):
+        return await self._fetchone("SELECT username, full_name, created_at FROM users WHERE user_id = ?", (user_id,))
+    
+    async def get_users_count(self):
+        row = await self._fetchone("SELECT COUNT(*) FROM users")
+        return row[0]
+    
+    async def get_total_orders_count(self):
+        row = await self._fetchone("SELECT COUNT(*) FROM orders")
+        return row[0]
+    
+    async def get_stats(self):
+        """Сводка для админки из таблиц-счётчиков: O(1) вместо агрегатов по orders"""
+        def run():
+            conn = self._connection(readonly=True)
+            today = conn.execute("SELECT DATE('now')").fetchone()[0]
+            totals = dict(conn.execute("SELECT key, value FROM stats_totals").fetchall())
+            daily = dict(conn.execute("SELECT key, value FROM stats_daily WHERE day = ?", (today,)).fetchall())
+            active_24h = conn.execute(
+                "SELECT COUNT(*) FROM user_activity WHERE last_order_at >= datetime('now', '-1 day')"
+            ).fetchone()[0]
+            return {
+                "today": today,
+                "users": int(totals.get("users", 0)),
+                "orders": int(totals.get("orders", 0)),
+                "active_orders": int(totals.get("active_orders", 0)),
+                "revenue": totals.get("revenue", 0),
+                "today_users": int(daily.get("users", 0)),
+                "today_orders": int(daily.get("orders", 0)),
+                "today_revenue": daily.get("revenue", 0),
+                "active_24h": active_24h
+            }
+        return await self._read(run)
+    
+    async def iter_orders(self, batch_size=500):
+        """Все заказы пачками по id — каждая пачка отдельным запросом, память не растёт с размером таблицы"""
+        last_id = 0
+        while True:
+            rows = await self._fetchall(f"{ORDER_SELECT} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))
+            if not rows:
+                return
+            batch = [Order(*row) for row in rows]
+            yield batch
+            last_id = batch[-1].id
+    
+    async def get_state(self, key):
+        row = await self._fetchone(
+            "SELECT data FROM fsm_states WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        )
+        return row[0] if row else None
+    
+    async def set_state(self, key, data, ttl):
+        await self._execute(
+            "INSERT INTO fsm_states (key, data, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+            (key, data, time.time() + ttl)
+        )
+    
+    async def delete_state(self, key):
+        await self._execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+    
+    async def purge_states(self):
+        cursor = await self._execute("DELETE FROM fsm_states WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+    
+    async def get_exchange_rates(self):
+        """Сохранённые курсы: ({(source, target): rate}, время обновления или None)"""
+        rows = await self._fetchall("SELECT source, target, rate, updated_at FROM exchange_rates")
+        rates = {(source, target): rate for source, target, rate, _ in rows}
+        return rates, max((row[3] for row in rows), default=None)
+    
+    async def save_exchange_rates(self, rates, updated_at):
+        def run(conn):
+            conn.executemany(
+                "INSERT INTO exchange_rates (source, target, rate, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(source, target) DO UPDATE SET rate = excluded.rate, updated_at = excluded.updated_at",
+                [(source, target, rate, updated_at) for (source, target), rate in rates.items()]
+            )
+        await self._transaction(run)
+    
+    async def get_orders_by_status(self, status):
+        rows = await self._fetchall(f"{ORDER_SELECT} WHERE status = ?", (status,))
+        return [Order(*row) for row in rows]
+    
+    async def update_orders_status(self, order_ids, status, expected_status, actor=None):
+        """Массовая смена статуса одной транзакцией; возвращает id реально обновлённых заказов"""
+        def run(conn):
+            return [
+                order_id for order_id in order_ids
+                if self._set_status(conn, order_id, status, expected_status, actor)
+            ]
+        return await self._transaction(run)
+    
+    async def get_order_events(self, order_id, limit=10):
+        """Последние переходы статуса заказа, от старых к новым"""
+        rows = await self._fetchall(
+            "SELECT from_status, to_status, actor, created_at FROM order_events "
+            "WHERE order_id = ? ORDER BY id DESC LIMIT ?",
+            (order_id, limit)
+        )
+        return rows[::-1]
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-db = Database()
+# Бот, БД, клиент CryptoBot и остальные сервисы создаёт create_app(): импорт модуля
+# не открывает БД и не создаёт сессий, поэтому он дёшев для скриптов и тестов.
+# Хендлеры берут сервисы из этих имён, поэтому в процессе работает одно приложение за раз
+bot = None
+dp = None
+db = None
+cryptobot = None
+rates = None
+state_storage = None
+user_states = None
+admin_confirmations = None
+notifier = None
+subscription_cache = None
+subscription_middleware = None
+user_lanes = None
+throttling = None
+cold_start = None
+background_tasks = None
+
+# Хендлеры сообщений собираются декораторами в список и регистрируются в create_app()
+MESSAGE_HANDLERS = []
+
+def on_message(*filters):
+    def decorator(handler):
+        MESSAGE_HANDLERS.append((filters, handler))
+        return handler
+    return decorator
+
+# ========== ХРАНИЛИЩЕ СОСТОЯНИЙ ==========
+class MemoryStateStorage:
+    """Состояния в памяти процесса: TTL на запись и ограничение числа записей (LRU)"""
+    
+    def __init__(self, ttl=STATE_TTL, maxsize=STATE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+    
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        
+        data, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        
+        self._entries.move_to_end(key)
+        return json.loads(data)
+    
+    async def set(self, key, value):
+        # Храним сериализованную копию: изменения словаря в хендлере не попадают в хранилище без set()
+        self._entries[key] = (json.dumps(value), time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    async def delete(self, key):
+        self._entries.pop(key, None)
+    
+    async def consume(self, key, value, add_order):
+        """Снимает состояние, если оно не менялось с чтения, и создаёт заказ; None — уже снято"""
+        if await self.get(key) != value:
+            return None
+        await self.delete(key)
+        return await add_order()
+
+class SQLiteStateStorage:
+    """Состояния в таблице fsm_states общего файла БД: переживают рестарт и видны всем процессам"""
+    
+    def __init__(self, database, ttl=STATE_TTL, purge_every=500):
+        self.db = database
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+    
+    async def get(self, key):
+        data = await self.db.get_state(key)
+        return json.loads(data) if data is not None else None
+    
+    async def set(self, key, value):
+        await self.db.set_state(key, json.dumps(value), self.ttl)
+        
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            await self.db.purge_states()
+    
+    async def delete(self, key):
+        await self.db.delete_state(key)
+    
+    async def consume(self, key, value, add_order):
+        """То же в одной транзакции с INSERT заказа — атомарно и между процессами"""
+        return await add_order(state_key=key, state_data=json.dumps(value))
+
+class StateNamespace:
+    """Состояния одного вида (пользовательские шаги, подтверждения админов) по user_id"""
+    
+    def __init__(self, storage, prefix):
+        self.storage = storage
+        self.prefix = prefix
+    
+    async def get(self, user_id):
+        return await self.storage.get(f"{self.prefix}:{user_id}")
+    
+    async def set(self, user_id, state):
+        await self.storage.set(f"{self.prefix}:{user_id}", state)
+    
+    async def delete(self, user_id):
+        await self.storage.delete(f"{self.prefix}:{user_id}")
+    
+    async def consume(self, user_id, state, add_order):
+        """Завершает шаг созданием заказа: add_order (db.add_order с уже подставленными полями заказа)
+        выполняется, только если state ещё не израсходован другим воркером. Возвращает id заказа или None"""
+        return await self.storage.consume(f"{self.prefix}:{user_id}", state, add_order)
 
-user_states = {}
-admin_confirmations = {}
+# ========== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ ==========
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+    
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    """Фоновая отправка уведомлений: хендлер ставит сообщения в очередь и сразу отвечает пользователю,
+    воркеры отправляют их параллельно в пределах лимитов Telegram (общий и на чат).
+    Задания одного чата отправляются по очереди, в порядке постановки"""
+    
+    def __init__(self, bot, workers=NOTIFY_WORKERS, global_rate=NOTIFY_GLOBAL_RATE / WORKERS,
+                 chat_rate=NOTIFY_CHAT_RATE, max_attempts=NOTIFY_MAX_ATTEMPTS):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        # chat_id -> [замок, число заданий чата у воркеров]; замок снимается с последним заданием
+        self._chat_locks = {}
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+    
+    def enqueue(self, chat_id, *methods):
+        """Методы одного задания отправляются в чат по порядку (например, фото и затем текст)"""
+        self.queue.put_nowait((chat_id, methods))
+    
+    def send_message(self, chat_id, text, **kwargs):
+        self.enqueue(chat_id, SendMessage(chat_id=chat_id, text=text, **kwargs))
+    
+    def notify_admins(self, *method_factories):
+        """method_factories — функции admin_id -> метод Bot API"""
+        for admin_id in ADMIN_IDS:
+            self.enqueue(admin_id, *(factory(admin_id) for factory in method_factories))
+    
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Уведомления: не отправлено {self.queue.qsize()} заданий при остановке")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Полные корзины ничего не ограничивают — их можно забыть
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 3)
+        return bucket
+    
+    async def _worker(self):
+        while True:
+            chat_id, methods = await self.queue.get()
+            # Замок берётся сразу после get() без переключения задач, а asyncio.Lock пропускает ожидающих
+            # по очереди — поэтому следующее задание того же чата у другого воркера ждёт этого
+            entry = self._chat_locks.get(chat_id)
+            if entry is None:
+                entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    for method in methods:
+                        await self._deliver(chat_id, method)
+            except Exception as e:
+                logger.warning(f"Уведомления: ошибка отправки в {chat_id}: {e}")
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chat_locks[chat_id]
+                self.queue.task_done()
+    
+    async def _deliver(self, chat_id, method):
+        for attempt in range(1, self.max_attempts + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot(method)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError):
+                self.retried += 1
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as e:
+                # Пользователь заблокировал бота, неверный chat_id и т.п. — повтор не поможет
+                self.failed += 1
+                logger.info(f"Уведомления: {chat_id} недоступен: {e}")
+                return
+        
+        self.failed += 1
+        logger.warning(f"Уведомления: не удалось отправить в {chat_id} за {self.max_attempts} попыток")
+    
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried
+        }
 
 # ========== НАСТРОЙКА MENU BUTTON ==========
 async def setup_menu_button():
@@ -251,7 +1394,56 @@ async def setup_menu_button():
         print(f"❌ Ошибка настройки menu button: {e}")
 
 # ========== ПРОВЕРКА ПОДПИСКИ НА КАНАЛ ==========
-async def check_subscription(user_id: int) -> bool:
+class SubscriptionCache:
+    """LRU-кэш результатов get_chat_member с разным TTL для подписанных и неподписанных"""
+    
+    def __init__(self, ttl=SUBSCRIPTION_CACHE_TTL, negative_ttl=SUBSCRIPTION_NEGATIVE_TTL, maxsize=SUBSCRIPTION_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # Незавершённые запросы get_chat_member по user_id — повторные проверки ждут тот же запрос
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return is_member
+    
+    def set(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+async def _fetch_subscription(user_id: int) -> bool:
     try:
         chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
         
@@ -261,144 +1453,494 @@ async def check_subscription(user_id: int) -> bool:
             ChatMemberStatus.CREATOR
         ]
         
-        return chat_member.status in valid_statuses
+        is_member = chat_member.status in valid_statuses
     except Exception as e:
+        # Ошибки API не кэшируем, чтобы временный сбой не блокировал пользователя
         return False
+    
+    subscription_cache.set(user_id, is_member)
+    return is_member
+
+async def check_subscription(user_id: int, force: bool = False) -> bool:
+    if not force:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+    
+    pending = subscription_cache.inflight
+    inflight = pending.get(user_id)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_fetch_subscription(user_id))
+        pending[user_id] = inflight
+        inflight.add_done_callback(lambda _: pending.pop(user_id, None))
+    
+    return await asyncio.shield(inflight)
+
+SUBSCRIBE_CAPTION = (
+    "<b>📢 Подпишитесь на канал</b>\n\n"
+    "Чтобы пользоваться ботом, необходимо подписаться на наш канал:\n\n"
+    f"👉 <b>Канал:</b> @{CHANNEL_USERNAME}\n\n"
+    "После подписки нажмите кнопку ниже для проверки:"
+)
 
 async def require_subscription(user_id: int, message: types.Message = None, callback: types.CallbackQuery = None):
-    subscribe_text = (
-        "<b>📢 Подпишитесь на канал</b>\n\n"
-        "Чтобы пользоваться ботом, необходимо подписаться на наш канал:\n\n"
-        f"👉 <b>Канал:</b> @{CHANNEL_USERNAME}\n\n"
-        "После подписки нажмите кнопку ниже для проверки:"
-    )
-    
-    subscribe_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
-        [InlineKeyboardButton(text="✅ Я подписался", callback_data="check_subscription")]
-    ])
-    
     if message:
-        await message.answer(subscribe_text, reply_markup=subscribe_kb, parse_mode="HTML")
+        await message.answer(SUBSCRIBE_CAPTION, reply_markup=subscribe_kb(), parse_mode="HTML")
     elif callback:
-        await callback.message.answer(subscribe_text, reply_markup=subscribe_kb, parse_mode="HTML")
+        await callback.message.answer(SUBSCRIBE_CAPTION, reply_markup=subscribe_kb(), parse_mode="HTML")
+
+# ========== CALLBACK DATA ==========
+# Формат: <версия>|<код действия>|<аргумент>|... — короткие коды держат данные в лимите Telegram (64 байта)
+CALLBACK_VERSION = "1"
+CALLBACK_DATA_LIMIT = 64
+CALLBACK_SEPARATOR = "|"
+
+class CallbackDataError(ValueError):
+    pass
+
+@dataclass(frozen=True, slots=True)
+class CallbackRoute:
+    action: str
+    code: str
+    arg_types: tuple
+    handler: object
+
+# Таблицы маршрутизации: код из callback_data -> маршрут и имя действия -> маршрут
+CALLBACK_ROUTES = {}
+CALLBACK_ACTIONS = {}
+
+def one_of(*values):
+    """Тип аргумента, допускающий только перечисленные строки"""
+    allowed = frozenset(values)
+    
+    def parse(value):
+        if value not in allowed:
+            raise ValueError(value)
+        return value
+    return parse
+
+def digits(value):
+    """Тип аргумента-идентификатора: только ASCII-цифры. int() принял бы и "1_2", " 12", "+5" или "١٢",
+    и у одной кнопки было бы несколько разных callback_data"""
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(value)
+    return int(value)
+
+def callback_action(action, code, *arg_types):
+    """Регистрирует хендлер колбэка под коротким кодом вместо отдельного фильтра F.data"""
+    def decorator(handler):
+        if code in CALLBACK_ROUTES or action in CALLBACK_ACTIONS:
+            raise RuntimeError(f"Колбэк {action}/{code} уже зарегистрирован")
+        route = CallbackRoute(action, code, arg_types, handler)
+        CALLBACK_ROUTES[code] = route
+        CALLBACK_ACTIONS[action] = route
+        return handler
+    return decorator
+
+def cb(action, *args):
+    """Собирает callback_data для действия с проверкой типов и длины"""
+    route = CALLBACK_ACTIONS[action]
+    if len(args) != len(route.arg_types):
+        raise CallbackDataError(f"{action}: ожидалось аргументов {len(route.arg_types)}, передано {len(args)}")
+    parts = [CALLBACK_VERSION, route.code]
+    for arg_type, arg in zip(route.arg_types, args):
+        value = str(arg)
+        if CALLBACK_SEPARATOR in value:
+            raise CallbackDataError(f"{action}: недопустимый символ в аргументе {value!r}")
+        try:
+            arg_type(value)
+        except ValueError:
+            raise CallbackDataError(f"{action}: неверный аргумент {value!r}") from None
+        parts.append(value)
+    data = CALLBACK_SEPARATOR.join(parts)
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise CallbackDataError(f"{action}: callback_data длиннее {CALLBACK_DATA_LIMIT} байт")
+    return data
+
+def _decode_legacy(data):
+    """Кнопки из сообщений, отправленных до перехода на кодек: main_menu, card_pay_12, ao:..., premium_3m"""
+    if data in CALLBACK_ACTIONS:
+        return CALLBACK_ACTIONS[data], []
+    if data.startswith("ao:"):
+        return CALLBACK_ACTIONS["orders_page"], data.split(":")[1:]
+    if data.startswith("premium_"):
+        return CALLBACK_ACTIONS["premium_period"], [data[len("premium_"):]]
+    action, _, arg = data.rpartition("_")
+    route = CALLBACK_ACTIONS.get(action)
+    if route is None:
+        raise CallbackDataError(data)
+    return route, [arg]
+
+@lru_cache(maxsize=4096)
+def decode_callback(data):
+    """Разбирает callback_data в (маршрут, типизированные аргументы); при ошибке — CallbackDataError"""
+    if not data or len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise CallbackDataError(data)
+    version, _, rest = data.partition(CALLBACK_SEPARATOR)
+    if version == CALLBACK_VERSION and rest:
+        code, *args = rest.split(CALLBACK_SEPARATOR)
+        route = CALLBACK_ROUTES.get(code)
+        if route is None:
+            raise CallbackDataError(data)
+    else:
+        route, args = _decode_legacy(data)
+    if len(args) != len(route.arg_types):
+        raise CallbackDataError(data)
+    try:
+        return route, tuple(arg_type(arg) for arg_type, arg in zip(route.arg_types, args))
+    except ValueError:
+        raise CallbackDataError(data) from None
+
+def callback_route(data):
+    """Маршрут колбэка или None для устаревших и мусорных данных"""
+    try:
+        return decode_callback(data)[0]
+    except CallbackDataError:
+        return None
+
+async def callback_router(callback: types.CallbackQuery):
+    """Единая точка входа для колбэков: поиск хендлера по коду за O(1)"""
+    try:
+        route, args = decode_callback(callback.data)
+    except CallbackDataError:
+        await callback.answer("⚠️ Кнопка устарела, откройте меню заново", show_alert=True)
+        return
+    await route.handler(callback, *args)
+
+# ========== MIDDLEWARE ПОДПИСКИ ==========
+# Колбэки оплаты не требуют подписки: пользователь уже в процессе покупки
+SUBSCRIPTION_EXEMPT_CALLBACKS = frozenset({"check_subscription", "card_pay", "crypto_pay", "check_crypto", "confirm_paid", "cancel_photo"})
+
+class SubscriptionMiddleware(BaseMiddleware):
+    """Единая проверка подписки для сообщений и колбэков вместо копий в каждом хендлере"""
+    
+    def __init__(self):
+        self.checks = 0
+        self.blocked = 0
+        self.total_time = 0.0
+    
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        message = event.message
+        callback = event.callback_query
+        
+        if user is None or user.id in ADMIN_IDS or (message is None and callback is None):
+            return await handler(event, data)
+        
+        if callback:
+            route = callback_route(callback.data)
+            if route is not None and route.action in SUBSCRIPTION_EXEMPT_CALLBACKS:
+                return await handler(event, data)
+        
+        if message and message.photo:
+            return await handler(event, data)
+        
+        started = time.perf_counter()
+        is_member = await check_subscription(user.id)
+        self.checks += 1
+        self.total_time += time.perf_counter() - started
+        
+        if not is_member:
+            self.blocked += 1
+            await require_subscription(user.id, message=message, callback=callback)
+            return
+        
+        return await handler(event, data)
+    
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "blocked": self.blocked,
+            "avg_ms": self.total_time / self.checks * 1000 if self.checks else 0.0
+        }
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==========
+# Оплата проходит всегда: пользователь уже платит, а повторы защищены переходами статусов заказа
+PAYMENT_CALLBACKS = frozenset({"card_pay", "crypto_pay", "check_crypto", "confirm_paid", "cancel_photo"})
+
+def action_class(update: types.Update):
+    if update.callback_query:
+        route = callback_route(update.callback_query.data)
+        if route is not None and route.action in PAYMENT_CALLBACKS:
+            return "payment"
+        return "navigation"
+    if update.message:
+        if update.message.photo:
+            return "payment"
+        if (update.message.text or "").startswith("/"):
+            return "navigation"
+        return "input"
+    return "other"
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Защита от флуда: token bucket на пользователя и класс действий, отброс двойных нажатий
+    и режим перегрузки, в котором отбрасывается навигация. Оплата и действия админов не ограничиваются."""
+    
+    def __init__(self, rates=THROTTLE_RATES, duplicate_window=THROTTLE_DUPLICATE_WINDOW,
+                 overload_inflight=THROTTLE_OVERLOAD_INFLIGHT):
+        self.rates = rates
+        self.duplicate_window = duplicate_window
+        self.overload_inflight = overload_inflight
+        self.inflight = 0
+        self._buckets = {}
+        self._recent_callbacks = {}
+        self.throttled = 0
+        self.duplicates = 0
+        self.shed = 0
+    
+    def _bucket(self, user_id, cls):
+        key = (user_id, cls)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                # Полные корзины ничего не ограничивают — их можно выбросить
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.is_full()}
+            bucket = self._buckets[key] = TokenBucket(*self.rates[cls])
+        return bucket
+    
+    def _is_duplicate(self, user_id, message_id, data):
+        now = time.monotonic()
+        key = (user_id, message_id, data)
+        last = self._recent_callbacks.get(key)
+        self._recent_callbacks[key] = now
+        if len(self._recent_callbacks) > 10000:
+            self._recent_callbacks = {
+                key: seen for key, seen in self._recent_callbacks.items() if now - seen < self.duplicate_window
+            }
+        return last is not None and now - last < self.duplicate_window
+    
+    def _allow(self, event: types.Update, user_id):
+        cls = action_class(event)
+        if cls not in self.rates:
+            return True
+        
+        callback = event.callback_query
+        message_id = callback.message.message_id if callback and callback.message else None
+        if callback and self._is_duplicate(user_id, message_id, callback.data):
+            self.duplicates += 1
+            return False
+        if cls == "navigation" and self.inflight >= self.overload_inflight:
+            self.shed += 1
+            return False
+        if not self._bucket(user_id, cls).try_acquire():
+            self.throttled += 1
+            return False
+        return True
+    
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id not in ADMIN_IDS and not self._allow(event, user.id):
+            # Пустой ответ ничего не показывает, но останавливает «часики» на кнопке
+            if event.callback_query:
+                try:
+                    await event.callback_query.answer()
+                except TelegramAPIError:
+                    pass
+            return
+        
+        self.inflight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.inflight -= 1
+    
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "overloaded": self.inflight >= self.overload_inflight,
+            "throttled": self.throttled,
+            "duplicates": self.duplicates,
+            "shed": self.shed
+        }
+
+# ========== ОЧЕРЕДИ АПДЕЙТОВ ПОЛЬЗОВАТЕЛЕЙ ==========
+class UserLane:
+    __slots__ = ("lock", "depth")
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+class UserLaneMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются по очереди, разных — параллельно.
+    
+    Хендлеры читают и меняют состояние диалога между await, поэтому два быстрых
+    сообщения подряд могли создать два заказа. asyncio.Lock отдаёт блокировку в порядке
+    ожидания, так что очередь сохраняет порядок апдейтов. Опустевшая очередь сразу удаляется.
+    Очереди локальны для процесса: при нескольких воркерах порядок между ними не гарантируется.
+    """
+    
+    def __init__(self, max_depth=USER_LANE_MAX_DEPTH):
+        self.max_depth = max_depth
+        self.lanes = {}
+        self.peak_depth = 0
+        self.waited = 0
+        self.dropped = 0
+        self.wait_time = 0.0
+    
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        
+        lane = self.lanes.get(user.id)
+        if lane is None:
+            lane = self.lanes[user.id] = UserLane()
+        elif lane.depth >= self.max_depth:
+            self.dropped += 1
+            if event.callback_query:
+                try:
+                    await event.callback_query.answer("⏳ Подождите, предыдущие действия ещё обрабатываются")
+                except TelegramAPIError:
+                    pass
+            return
+        
+        lane.depth += 1
+        self.peak_depth = max(self.peak_depth, lane.depth)
+        try:
+            if lane.lock.locked():
+                self.waited += 1
+                started = time.perf_counter()
+                await lane.lock.acquire()
+                self.wait_time += time.perf_counter() - started
+            else:
+                await lane.lock.acquire()
+            try:
+                return await handler(event, data)
+            finally:
+                lane.lock.release()
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0:
+                del self.lanes[user.id]
+    
+    def stats(self):
+        return {
+            "lanes": len(self.lanes),
+            "queued": sum(lane.depth for lane in self.lanes.values()),
+            "peak_depth": self.peak_depth,
+            "waited": self.waited,
+            "dropped": self.dropped,
+            "avg_wait_ms": self.wait_time / self.waited * 1000 if self.waited else 0.0
+        }
 
 # ========== КЛАВИАТУРЫ ==========
+# Разметка aiogram неизменяема (frozen), поэтому клавиатуры собираются один раз и
+# переиспользуются; параметризованные — через ограниченный кэш. Изменять их нельзя
+@lru_cache(maxsize=None)
 def main_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars"),
-            InlineKeyboardButton(text="👑 Купить премиум", callback_data="buy_premium")
+            InlineKeyboardButton(text="⭐️ Купить звезды", callback_data=cb("buy_stars")),
+            InlineKeyboardButton(text="👑 Купить премиум", callback_data=cb("buy_premium"))
         ],
         [
-            InlineKeyboardButton(text="💱 Обмен валют", callback_data="exchange"),
-            InlineKeyboardButton(text="🧮 Калькулятор", callback_data="calculator")
+            InlineKeyboardButton(text="💱 Обмен валют", callback_data=cb("exchange")),
+            InlineKeyboardButton(text="🧮 Калькулятор", callback_data=cb("calculator"))
         ],
         [
-            InlineKeyboardButton(text="🎩 Профиль", callback_data="profile"),
-            InlineKeyboardButton(text="📊 Информация", callback_data="info")
+            InlineKeyboardButton(text="🎩 Профиль", callback_data=cb("profile")),
+            InlineKeyboardButton(text="📊 Информация", callback_data=cb("info"))
         ],
         [
             InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER}")
         ]
     ])
 
+@lru_cache(maxsize=None)
 def back_to_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=cb("main_menu"))]
     ])
 
+@lru_cache(maxsize=None)
 def admin_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 Активные заказы", callback_data="admin_active_orders")],
-        [InlineKeyboardButton(text="🤖 Бот", callback_data="admin_bot_stats")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="📦 Активные заказы", callback_data=cb("admin_active_orders"))],
+        [InlineKeyboardButton(text="🤖 Бот", callback_data=cb("admin_bot_stats"))],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data=cb("admin_stats"))],
+        [InlineKeyboardButton(text="🔙 В меню", callback_data=cb("main_menu"))]
     ])
 
+@lru_cache(maxsize=1024)
 def confirm_payment_kb(order_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"confirm_paid_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=cb("confirm_paid", order_id))],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=cb("main_menu"))]
     ])
 
+@lru_cache(maxsize=1024)
 def back_kb(target):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data=target)]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb(target))]
     ])
 
+@lru_cache(maxsize=None)
 def calculator_back_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("main_menu"))]
+    ])
+
+@lru_cache(maxsize=None)
+def subscribe_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
+        [InlineKeyboardButton(text="✅ Я подписался", callback_data=cb("check_subscription"))]
+    ])
+
+@lru_cache(maxsize=None)
+def premium_periods_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="3 месяца", callback_data=cb("premium_period", "3m"))],
+        [InlineKeyboardButton(text="6 месяцев", callback_data=cb("premium_period", "6m"))],
+        [InlineKeyboardButton(text="1 год", callback_data=cb("premium_period", "1y"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("main_menu"))]
     ])
 
 # ========== ГЛАВНОЕ МЕНЮ С ЦИТАТОЙ ==========
-@dp.message(CommandStart())
+MAIN_MENU_CAPTION = (
+    "<b>🪐 Digi Store - Главное меню</b>\n\n"
+    "<blockquote>C помощью нашего магазина вы можете:\n"
+    "• ⭐️ Купить Telegram Stars\n"
+    "• 👑 Купить Telegram Premium\n"
+    "• 💱 Обменять рубли на доллары</blockquote>\n\n"
+    "<b>Выберите действие:</b>"
+)
+
+@on_message(CommandStart())
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, message=message)
-        return
-    
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
     
-    db.add_user(user_id, username, full_name)
-    
-    caption = (
-        "<b>🪐 Digi Store - Главное меню</b>\n\n"
-        "<blockquote>C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары</blockquote>\n\n"
-        "<b>Выберите действие:</b>"
-    )
+    await db.add_user(user_id, username, full_name)
     
     await message.answer(
-        text=caption,
+        text=MAIN_MENU_CAPTION,
         reply_markup=main_menu_kb(),
         parse_mode="HTML"
     )
 
 async def show_main_menu(message: types.Message):
-    caption = (
-        "<b>🪐 Digi Store - Главное меню</b>\n\n"
-        "<blockquote>C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары</blockquote>\n\n"
-        "<b>Выберите действие:</b>"
-    )
-    
     await message.answer(
-        text=caption,
+        text=MAIN_MENU_CAPTION,
         reply_markup=main_menu_kb(),
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data == "check_subscription")
+@callback_action("check_subscription", "cs")
 async def check_subscription_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
-    if await check_subscription(user_id):
+    if await check_subscription(user_id, force=True):
         username = callback.from_user.username or ""
         full_name = callback.from_user.full_name
         
-        db.add_user(user_id, username, full_name)
-        
-        caption = (
-            "<b>✅ Отлично! Вы подписаны на канал.</b>\n\n"
-            "<b>🪐 Digi Store - Главное меню</b>\n\n"
-            "<blockquote>C помощью нашего магазина вы можете:\n"
-            "• ⭐️ Купить Telegram Stars\n"
-            "• 👑 Купить Telegram Premium\n"
-            "• 💱 Обменять рубли на доллары</blockquote>\n\n"
-            "<b>Выберите действие:</b>"
-        )
+        await db.add_user(user_id, username, full_name)
         
         await callback.message.edit_text(
-            text=caption,
+            text="<b>✅ Отлично! Вы подписаны на канал.</b>\n\n" + MAIN_MENU_CAPTION,
             reply_markup=main_menu_kb(),
             parse_mode="HTML"
         )
@@ -408,44 +1950,25 @@ async def check_subscription_handler(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data == "main_menu")
+@callback_action("main_menu", "mm")
 async def main_menu_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    caption = (
-        "<b>🪐 Digi Store - Главное меню</b>\n\n"
-        "<blockquote>C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары</blockquote>\n\n"
-        "<b>Выберите действие:</b>"
-    )
-    
     await callback.message.edit_text(
-        text=caption,
+        text=MAIN_MENU_CAPTION,
         reply_markup=main_menu_kb(),
         parse_mode="HTML"
     )
     await callback.answer()
 
 # ========== ПРОФИЛЬ ==========
-@dp.callback_query(F.data == "profile")
+@callback_action("profile", "pf")
 async def profile_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    user_info = db.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     
     if user_info:
         username, full_name, created_at = user_info
-        orders_count = db.get_user_orders_count(user_id)
+        orders_count = await db.get_user_orders_count(user_id)
         
         if created_at:
             if isinstance(created_at, str):
@@ -477,8 +2000,8 @@ async def profile_handler(callback: types.CallbackQuery):
         )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="profile")],
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=cb("profile"))],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=cb("main_menu"))]
     ])
     
     await callback.message.edit_text(
@@ -489,15 +2012,9 @@ async def profile_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== КАЛЬКУЛЯТОР ==========
-@dp.callback_query(F.data == "calculator")
+@callback_action("calculator", "cl")
 async def calculator_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    user_states[callback.from_user.id] = {"action": "waiting_calculation"}
+    await user_states.set(callback.from_user.id, {"action": "waiting_calculation"})
     
     example_text = (
         "<blockquote>1+1=2</blockquote>\n\n"
@@ -523,32 +2040,128 @@ async def calculator_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+# Ограничения калькулятора: разбор и вычисление укладываются в доли миллисекунды
+CALC_MAX_LENGTH = 200
+CALC_MAX_TOKENS = 100
+CALC_MAX_DEPTH = 20
+CALC_MAX_ABS = Decimal("1e30")
+CALC_CONTEXT = Context(prec=28, traps=[DivisionByZero, InvalidOperation, Overflow])
+
+CALC_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?|\.\d+|[-+*/()]")
+CALC_PRECEDENCE = {"+": 1, "-": 1, "*": 2, "/": 2, "neg": 3}
+CALC_OPERATIONS = {
+    "+": CALC_CONTEXT.add,
+    "-": CALC_CONTEXT.subtract,
+    "*": CALC_CONTEXT.multiply,
+    "/": CALC_CONTEXT.divide,
+}
+
+class CalculatorError(ValueError):
+    pass
+
+def _check_magnitude(value):
+    if abs(value) > CALC_MAX_ABS:
+        raise CalculatorError("Слишком большое число")
+    return value
+
+@lru_cache(maxsize=1024)
+def compile_expression(expression):
+    """Разбирает выражение в обратную польскую запись (сортировочная станция)"""
+    if "**" in expression or "^" in expression:
+        raise CalculatorError("Возведение в степень не поддерживается (доступны + - * /)")
+    tokens = CALC_TOKEN_RE.findall(expression)
+    if "".join(tokens) != expression:
+        raise CalculatorError("Недопустимые символы в выражении")
+    if not tokens:
+        raise CalculatorError("Пустое выражение")
+    if len(tokens) > CALC_MAX_TOKENS:
+        raise CalculatorError("Слишком длинное выражение")
+    
+    output, operators = [], []
+    depth = 0
+    expect_operand = True
+    for token in tokens:
+        if token[0].isdigit() or token[0] == ".":
+            if not expect_operand:
+                raise CalculatorError("Пропущен оператор")
+            output.append(_check_magnitude(Decimal(token)))
+            expect_operand = False
+        elif token == "(":
+            if not expect_operand:
+                raise CalculatorError("Пропущен оператор")
+            depth += 1
+            if depth > CALC_MAX_DEPTH:
+                raise CalculatorError("Слишком много вложенных скобок")
+            operators.append(token)
+        elif token == ")":
+            if expect_operand or depth == 0:
+                raise CalculatorError("Неверно расставлены скобки")
+            while operators[-1] != "(":
+                output.append(operators.pop())
+            operators.pop()
+            depth -= 1
+        elif expect_operand:
+            # Унарный плюс ничего не меняет, унарный минус — отдельная операция
+            if token == "-":
+                operators.append("neg")
+            elif token != "+":
+                raise CalculatorError("Пропущено число")
+        else:
+            while (operators and operators[-1] != "("
+                   and CALC_PRECEDENCE[operators[-1]] >= CALC_PRECEDENCE[token]):
+                output.append(operators.pop())
+            operators.append(token)
+            expect_operand = True
+    
+    if expect_operand:
+        raise CalculatorError("Выражение не закончено")
+    if depth:
+        raise CalculatorError("Неверно расставлены скобки")
+    output.extend(reversed(operators))
+    return tuple(output)
+
+def evaluate_rpn(program):
+    stack = []
+    for item in program:
+        if isinstance(item, Decimal):
+            stack.append(item)
+        elif item == "neg":
+            stack.append(-stack.pop())
+        else:
+            right = stack.pop()
+            left = stack.pop()
+            # 0/0 в decimal — InvalidOperation, а не DivisionByZero, поэтому ноль проверяется явно
+            if item == "/" and not right:
+                raise CalculatorError("Деление на ноль невозможно")
+            stack.append(_check_magnitude(CALC_OPERATIONS[item](left, right)))
+    return stack[0]
+
+def format_decimal(value):
+    if value == value.to_integral_value():
+        return str(int(value))
+    # До 10 знаков после запятой, если целая часть оставляет место в точности контекста
+    if value.adjusted() < CALC_CONTEXT.prec - 10:
+        value = value.quantize(Decimal("1e-10"), context=CALC_CONTEXT)
+    return format(value.normalize(CALC_CONTEXT), "f")
+
 def calculate_expression(expression: str):
+    expression = expression.replace('×', '*').replace(':', '/').replace(' ', '')
+    if len(expression) > CALC_MAX_LENGTH:
+        return None, "Слишком длинное выражение"
+    
     try:
-        expression = expression.replace('×', '*').replace(':', '/')
-        expression = expression.replace(' ', '')
-        
-        allowed_chars = set('0123456789+-*/.() ')
-        if not all(c in allowed_chars for c in expression):
-            return None, "Недопустимые символы в выражении"
-        
-        result = eval(expression)
-        return result, None
-    except ZeroDivisionError:
+        return format_decimal(evaluate_rpn(compile_expression(expression))), None
+    except DivisionByZero:
         return None, "Деление на ноль невозможно"
-    except Exception as e:
-        return None, f"Ошибка в выражении: {str(e)}"
+    except CalculatorError as e:
+        return None, str(e)
+    except (InvalidOperation, Overflow):
+        return None, "Слишком большое число"
 
 # ========== ПОКУПКА ЗВЕЗД ==========
-@dp.callback_query(F.data == "buy_stars")
+@callback_action("buy_stars", "bs")
 async def buy_stars_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    user_states[callback.from_user.id] = {"action": "waiting_stars_recipient"}
+    await user_states.set(callback.from_user.id, {"action": "waiting_stars_recipient"})
     
     caption = (
         "<b>⭐️ Покупка Telegram Stars</b>\n\n"
@@ -564,82 +2177,49 @@ async def buy_stars_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_premium")
+PREMIUM_CAPTION = (
+    "<b>👑 Покупка Telegram Premium</b>\n\n"
+    "<b>Выберите период:</b>\n\n"
+    + "".join(f"• <b>{value['name']}:</b> {value['rub']:.2f} RUB\n" for value in PREMIUM_PRICES.values())
+)
+
+@callback_action("buy_premium", "bp")
 async def buy_premium_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    price_text = ""
-    for key, value in PREMIUM_PRICES.items():
-        price_text += f"• <b>{value['name']}:</b> {value['rub']:.2f} RUB\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="3 месяца", callback_data="premium_3m")],
-        [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6m")],
-        [InlineKeyboardButton(text="1 год", callback_data="premium_1y")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
+    await callback.message.edit_text(
+        text=PREMIUM_CAPTION,
+        reply_markup=premium_periods_kb(),
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+@callback_action("premium_period", "pp", one_of(*PREMIUM_PRICES))
+async def premium_period_handler(callback: types.CallbackQuery, period: str):
+    await user_states.set(callback.from_user.id, {
+        "action": "waiting_premium_recipient",
+        "period": period,
+        "amount_rub": PREMIUM_PRICES[period]["rub"]
+    })
     
     caption = (
-        "<b>👑 Покупка Telegram Premium</b>\n\n"
-        "<b>Выберите период:</b>\n\n"
-        f"{price_text}"
+        f"<b>👑 Telegram Premium - {PREMIUM_PRICES[period]['name']}</b>\n\n"
+        f"<b>Цена:</b> {PREMIUM_PRICES[period]['rub']:.2f} RUB\n\n"
+        "<b>✏️ Введите username получателя (можно с @):</b>"
     )
     
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=back_kb("buy_premium"),
         parse_mode="HTML"
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("premium_"))
-async def premium_period_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    period = callback.data.replace("premium_", "")
-    
-    if period in PREMIUM_PRICES:
-        user_states[callback.from_user.id] = {
-            "action": "waiting_premium_recipient",
-            "period": period,
-            "amount_rub": PREMIUM_PRICES[period]["rub"]
-        }
-        
-        caption = (
-            f"<b>👑 Telegram Premium - {PREMIUM_PRICES[period]['name']}</b>\n\n"
-            f"<b>Цена:</b> {PREMIUM_PRICES[period]['rub']:.2f} RUB\n\n"
-            "<b>✏️ Введите username получателя (можно с @):</b>"
-        )
-        
-        await callback.message.edit_text(
-            text=caption,
-            reply_markup=back_kb("buy_premium"),
-            parse_mode="HTML"
-        )
-    
-    await callback.answer()
-
-@dp.callback_query(F.data == "exchange")
+@callback_action("exchange", "ex")
 async def exchange_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
-    user_states[callback.from_user.id] = {"action": "waiting_exchange_amount"}
+    await user_states.set(callback.from_user.id, {"action": "waiting_exchange_amount"})
     
     caption = (
         "<b>💱 Обмен валют</b>\n\n"
-        f"<b>Курс:</b> 1 USD = {USD_RATE} RUB\n\n"
+        f"<b>Курс:</b> 1 USD = {rates.usd_rub():.2f} RUB\n\n"
         "<b>Введите сумму в рублях для обмена:</b>\n"
         "(Минимум: 100 RUB)\n\n"
         "<b>💳 Оплата только картой!</b>"
@@ -652,18 +2232,12 @@ async def exchange_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "info")
+@callback_action("info", "in")
 async def info_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    
-    if not await check_subscription(user_id):
-        await require_subscription(user_id, callback=callback)
-        return
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
         [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("main_menu"))]
     ])
     
     caption = "<b>📊 Информация</b>\n\n<b>Выберите раздел:</b>"
@@ -676,7 +2250,7 @@ async def info_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== АДМИН ПАНЕЛЬ ==========
-@dp.message(Command("admin"))
+@on_message(Command("admin"))
 async def admin_panel(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ Доступ запрещен")
@@ -690,31 +2264,25 @@ async def admin_panel(message: types.Message):
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data == "admin_bot_stats")
+@callback_action("admin_bot_stats", "ab")
 async def admin_bot_stats_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    users_count = db.get_users_count()
-    orders_count = db.get_total_orders_count()
-    active_orders = len(db.get_active_orders())
-    total_revenue = db.get_total_revenue()
+    stats = await db.get_stats()
     
-    cursor = db.conn.cursor()
-    today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?", (today,))
-    today_users = cursor.fetchone()[0]
+    users_count = stats["users"]
+    orders_count = stats["orders"]
+    active_orders = stats["active_orders"]
+    total_revenue = stats["revenue"]
     
-    cursor.execute("SELECT COUNT(*) FROM orders WHERE DATE(created_at) = ?", (today,))
-    today_orders = cursor.fetchone()[0]
+    today = stats["today"]
+    today_users = stats["today_users"]
+    today_orders = stats["today_orders"]
+    today_revenue = stats["today_revenue"]
     
-    cursor.execute("SELECT SUM(amount_rub) FROM orders WHERE DATE(created_at) = ? AND status IN ('confirmed', 'completed')", (today,))
-    today_revenue_result = cursor.fetchone()[0]
-    today_revenue = today_revenue_result if today_revenue_result else 0
-    
-    cursor.execute("SELECT COUNT(DISTINCT user_id) FROM orders WHERE created_at >= datetime('now', '-1 day')")
-    active_last_24h = cursor.fetchone()[0]
+    active_last_24h = stats["active_24h"]
     
     caption = (
         "<b>🤖 Статистика бота</b>\n\n"
@@ -729,15 +2297,43 @@ async def admin_bot_stats_handler(callback: types.CallbackQuery):
         f"├ <b>Новых пользователей:</b> {today_users}\n"
         f"├ <b>Новых заказов:</b> {today_orders}\n"
         f"└ <b>Выручка за день:</b> {today_revenue:.2f} RUB\n\n"
-        
-        f"<b>📈 Средний чек:</b> {total_revenue/orders_count:.2f} RUB\n" if orders_count > 0 else ""
-        f"<b>🏪 Конверсия:</b> {orders_count/users_count*100:.1f}%\n" if users_count > 0 else ""
     )
+    if orders_count > 0:
+        caption += f"<b>📈 Средний чек:</b> {total_revenue/orders_count:.2f} RUB\n"
+    if users_count > 0:
+        caption += f"<b>🏪 Конверсия:</b> {orders_count/users_count*100:.1f}%\n"
+    
+    rate_stats = rates.stats()
+    rate_age = f"{rate_stats['age'] / 60:.0f} мин назад" if rate_stats["age"] is not None else "по умолчанию"
+    caption += f"<b>💱 Курс USD/RUB:</b> {rate_stats['usd_rub']:.2f} ({rate_age})\n"
+    
+    if metrics:
+        caption += "\n<b>⏱ Задержки (среднее / p95):</b>\n"
+        for kind, title in (("telegram", "Telegram API"), ("cryptobot", "CryptoBot"), ("db", "База данных")):
+            count, avg_ms, errors = metrics.totals(kind)
+            if count:
+                caption += f"├ <b>{title}:</b> {count} запр., {avg_ms:.1f} мс, ошибок {errors}\n"
+        lanes = user_lanes.stats()
+        caption += (
+            f"├ <b>Очереди пользователей:</b> {lanes['lanes']} активн., макс. глубина {lanes['peak_depth']}, "
+            f"ожиданий {lanes['waited']} ({lanes['avg_wait_ms']:.1f} мс), отброшено {lanes['dropped']}\n"
+        )
+        if throttling:
+            throttle = throttling.stats()
+            caption += (
+                f"├ <b>Флуд-контроль:</b> ограничено {throttle['throttled']}, повторов {throttle['duplicates']}, "
+                f"сброшено при перегрузке {throttle['shed']}\n"
+            )
+        slowest = metrics.summary("handler", limit=5)
+        if slowest:
+            caption += "<b>🐢 Самые медленные хендлеры:</b>\n"
+            for name, count, avg_ms, p95_ms in slowest:
+                caption += f"├ <code>{name}</code>: {avg_ms:.0f} / {p95_ms:.0f} мс ({count})\n"
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_bot_stats")],
-        [InlineKeyboardButton(text="📦 Активные заказы", callback_data="admin_active_orders")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=cb("admin_bot_stats"))],
+        [InlineKeyboardButton(text="📦 Активные заказы", callback_data=cb("admin_active_orders"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("admin_back"))]
     ])
     
     await callback.message.edit_text(
@@ -747,47 +2343,182 @@ async def admin_bot_stats_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.message(Command("dbcheck"))
-async def db_check_command(message: types.Message):
+# Лимит Telegram на длину сообщения и пауза между частями отчёта (≈1 сообщение в секунду на чат)
+MESSAGE_LIMIT = 4096
+DBCHECK_SEND_INTERVAL = 1.0
+DBCHECK_MAX_MESSAGES = 20
+DBCHECK_EXPORT_COLUMNS = ORDER_COLUMNS
+
+async def send_report_chunk(message: types.Message, text):
+    while True:
+        try:
+            await message.answer(text, parse_mode="HTML")
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+async def export_orders_file(message: types.Message, export_format):
+    """Выгрузка всех заказов в CSV/JSONL: файл пишется пачками, в памяти только одна пачка"""
+    export_file = tempfile.NamedTemporaryFile(
+        "w", suffix=f".{export_format}", delete=False, encoding="utf-8", newline=""
+    )
+    path = export_file.name
+    try:
+        with export_file:
+            writer = csv.writer(export_file)
+            
+            def write_batch(batch):
+                for order in batch:
+                    row = [getattr(order, column) for column in DBCHECK_EXPORT_COLUMNS]
+                    if export_format == "csv":
+                        writer.writerow(row)
+                    else:
+                        export_file.write(json.dumps(dict(zip(DBCHECK_EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+            
+            if export_format == "csv":
+                writer.writerow(DBCHECK_EXPORT_COLUMNS)
+            
+            # Запись на диск блокирует — выполняется в потоке, чтобы не задерживать другие апдейты
+            async for batch in db.iter_orders():
+                await asyncio.to_thread(write_batch, batch)
+        
+        filename = f"orders_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+        await message.answer_document(FSInputFile(path, filename=filename), caption="<b>📋 Выгрузка заказов</b>", parse_mode="HTML")
+    finally:
+        os.remove(path)
+
+@on_message(Command("dbcheck"))
+async def db_check_command(message: types.Message, command: CommandObject):
     if message.from_user.id not in ADMIN_IDS:
         return
     
+    export_format = (command.args or "").strip().lower()
+    
     try:
-        cursor = db.conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        orders_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT id, order_type, status, amount_rub FROM orders ORDER BY id")
-        all_orders = cursor.fetchall()
+        users_count = await db.get_users_count()
+        orders_count = await db.get_total_orders_count()
         
         report = f"<b>📊 Отчет базы данных:</b>\n\n"
         report += f"<b>👥 Пользователей:</b> {users_count}\n"
         report += f"<b>📦 Всего заказов:</b> {orders_count}\n\n"
         
-        if all_orders:
-            report += "<b>📋 Список всех заказов:</b>\n"
-            for order in all_orders:
-                order_id, order_type, status, amount_rub = order
-                report += f"#{order_id} | {order_type} | {status} | {amount_rub:.2f} RUB\n"
-        else:
+        if export_format in ("csv", "jsonl"):
+            await message.answer(report + "⏳ Готовлю файл выгрузки...", parse_mode="HTML")
+            await export_orders_file(message, export_format)
+            return
+        
+        if not orders_count:
             report += "❌ <b>Заказов нет в базе</b>\n"
+            await message.answer(report, parse_mode="HTML")
+            return
+        
+        report += "<b>📋 Список всех заказов:</b>\n"
+        sent_messages = 0
+        
+        async for batch in db.iter_orders():
+            for order in batch:
+                line = f"#{order.id} | {order.order_type} | {order.status} | {order.amount_rub:.2f} RUB\n"
+                
+                if len(report) + len(line) > MESSAGE_LIMIT:
+                    await send_report_chunk(message, report)
+                    sent_messages += 1
+                    report = ""
+                    
+                    if sent_messages >= DBCHECK_MAX_MESSAGES:
+                        await message.answer(
+                            "⚠️ <b>Список слишком большой для чата.</b>\n"
+                            "Полная выгрузка: /dbcheck csv или /dbcheck jsonl",
+                            parse_mode="HTML"
+                        )
+                        return
+                    
+                    await asyncio.sleep(DBCHECK_SEND_INTERVAL)
+                
+                report += line
         
-        await message.answer(report, parse_mode="HTML")
+        if report:
+            await send_report_chunk(message, report)
         
     except Exception as e:
         await message.answer(f"❌ <b>Ошибка БД:</b> {e}", parse_mode="HTML")
 
-@dp.callback_query(F.data == "admin_active_orders")
-async def admin_active_orders_handler(callback: types.CallbackQuery):
+# Фильтры списка активных заказов; страница кодируется как orders_page(<статус>, <тип>, <n|p>, <id курсора>)
+ORDER_STATUS_FILTERS = ["all", "waiting_confirmation", "waiting_crypto", "confirmed", "waiting_payment", "pending"]
+ORDER_TYPE_FILTERS = ["all", "stars", "premium", "exchange"]
+ORDER_TYPE_NAMES = {"all": "все", "stars": "⭐️ звезды", "premium": "👑 премиум", "exchange": "💱 обмен"}
+
+ORDER_STATUS_EMOJI = {
+    'pending': '⏳',
+    'waiting_payment': '💳',
+    'waiting_confirmation': '📸',
+    'waiting_crypto': '💎',
+    'confirmed': '✅'
+}
+
+def orders_page_data(status="all", order_type="all", direction="n", cursor_id=0):
+    return cb("orders_page", status, order_type, direction, cursor_id)
+
+def format_order_summary(order: Order):
+    status_emoji = ORDER_STATUS_EMOJI.get(order.status, '❓')
+    created_short = str(order.created_at)[:16] if order.created_at else "---"
+    
+    text = f"{status_emoji} <b>Заказ #{order.id}</b>\n"
+    text += f"<b>Тип:</b> {order.order_type}\n"
+    
+    if order.order_type == "stars":
+        text += f"<b>Кол-во:</b> {order.stars or 0} звезд\n"
+    elif order.order_type == "premium":
+        period_name = PREMIUM_PRICES.get(order.period, {}).get("name", "")
+        text += f"<b>Период:</b> {period_name}\n"
+    elif order.order_type == "exchange":
+        text += f"<b>К выдаче:</b> {order.amount_usd or 0:.2f} USD\n"
+    
+    if order.recipient:
+        text += f"<b>👤 Получатель:</b> @{order.recipient}\n"  # Добавлен @ перед юзернеймом
+    
+    text += f"<b>Сумма:</b> {order.amount_rub:.2f} RUB\n"
+    text += f"<b>Метод:</b> {order.payment_method}\n"
+    text += f"<b>Дата:</b> {created_short}\n"
+    text += f"<b>Статус:</b> {order.status}\n\n"
+    return text
+
+@callback_action("admin_active_orders", "aa")
+@callback_action("orders_page", "ao", one_of(*ORDER_STATUS_FILTERS), one_of(*ORDER_TYPE_FILTERS), one_of("n", "p"), digits)
+async def admin_active_orders_handler(callback: types.CallbackQuery, status_filter="all", type_filter="all", direction="n", cursor_id=0):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_active_orders()
+    # Без аргументов (кнопка меню, возврат после подтверждения) открывается первая страница
+    status = None if status_filter == "all" else status_filter
+    order_type = None if type_filter == "all" else type_filter
+    
+    total = await db.count_active_orders(status, order_type)
+    orders, has_more = await db.get_active_orders_page(
+        cursor_id=cursor_id, direction=direction, status=status, order_type=order_type
+    )
+    
+    if direction == "n":
+        has_next, has_prev = has_more, cursor_id > 0
+    else:
+        has_next, has_prev = True, has_more
+    
+    filters_row = [
+        InlineKeyboardButton(
+            text=f"📊 Статус: {status_filter if status else 'все'}",
+            callback_data=orders_page_data(
+                ORDER_STATUS_FILTERS[(ORDER_STATUS_FILTERS.index(status_filter) + 1) % len(ORDER_STATUS_FILTERS)],
+                type_filter
+            )
+        ),
+        InlineKeyboardButton(
+            text=f"📦 Тип: {ORDER_TYPE_NAMES[type_filter]}",
+            callback_data=orders_page_data(
+                status_filter,
+                ORDER_TYPE_FILTERS[(ORDER_TYPE_FILTERS.index(type_filter) + 1) % len(ORDER_TYPE_FILTERS)]
+            )
+        )
+    ]
     
     if not orders:
         caption = (
@@ -800,73 +2531,59 @@ async def admin_active_orders_handler(callback: types.CallbackQuery):
         )
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_active_orders")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+            filters_row,
+            [InlineKeyboardButton(text="🔄 Обновить", callback_data=orders_page_data(status_filter, type_filter))],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("admin_back"))]
         ])
     else:
-        caption = "<b>📦 Активные заказы</b>\n\n"
+        caption = f"<b>📦 Активные заказы</b> (всего: {total})\n\n"
         
         keyboard_buttons = []
+        shown_ids = []
         
         for order in orders:
-            order_id, user_id, order_type, recipient, details, amount_rub, payment_method, status, created_at = order
-            
-            status_emoji = {
-                'pending': '⏳',
-                'waiting_payment': '💳',
-                'waiting_confirmation': '📸',
-                'waiting_crypto': '💎',
-                'confirmed': '✅'
-            }.get(status, '❓')
-            
-            if created_at:
-                if isinstance(created_at, str):
-                    created_short = created_at[:16]
-                else:
-                    created_short = str(created_at)[:16]
-            else:
-                created_short = "---"
-            
-            caption += f"{status_emoji} <b>Заказ #{order_id}</b>\n"
-            caption += f"<b>Тип:</b> {order_type}\n"
-            
-            try:
-                details_dict = json.loads(details) if details else {}
-                
-                if order_type == "stars":
-                    stars = details_dict.get("stars", 0)
-                    caption += f"<b>Кол-во:</b> {stars} звезд\n"
-                elif order_type == "premium":
-                    period = details_dict.get("period", "")
-                    period_name = PREMIUM_PRICES.get(period, {}).get("name", "")
-                    caption += f"<b>Период:</b> {period_name}\n"
-                elif order_type == "exchange":
-                    amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                    caption += f"<b>К выдаче:</b> {amount_usd:.2f} USD\n"
-            except:
-                pass
-            
-            if recipient:
-                caption += f"<b>👤 Получатель:</b> @{recipient}\n"  # Добавлен @ перед юзернеймом
-            
-            caption += f"<b>Сумма:</b> {amount_rub:.2f} RUB\n"
-            caption += f"<b>Метод:</b> {payment_method}\n"
-            caption += f"<b>Дата:</b> {created_short}\n"
-            caption += f"<b>Статус:</b> {status}\n\n"
+            order_text = format_order_summary(order)
+            # Лимит Telegram на текст сообщения — 4096 символов
+            if len(caption) + len(order_text) > 4000:
+                break
+            caption += order_text
+            shown_ids.append(order.id)
             
             keyboard_buttons.append([
                 InlineKeyboardButton(
-                    text=f"📦 Управление заказом #{order_id}", 
-                    callback_data=f"manage_order_{order_id}"
+                    text=f"📦 Управление заказом #{order.id}", 
+                    callback_data=cb("manage_order", order.id)
                 )
             ])
         
+        if len(shown_ids) < len(orders):
+            has_next = True
+        
+        nav_row = []
+        if has_prev:
+            nav_row.append(InlineKeyboardButton(
+                text="⬅️ Назад",
+                callback_data=orders_page_data(status_filter, type_filter, "p", shown_ids[0])
+            ))
+        if has_next:
+            nav_row.append(InlineKeyboardButton(
+                text="Вперед ➡️",
+                callback_data=orders_page_data(status_filter, type_filter, "n", shown_ids[-1])
+            ))
+        if nav_row:
+            keyboard_buttons.append(nav_row)
+        
+        keyboard_buttons.append(filters_row)
+        
         keyboard_buttons.append([
-            InlineKeyboardButton(text="🔄 Обновить список", callback_data="admin_active_orders")
+            InlineKeyboardButton(
+                text="🔄 Обновить список",
+                callback_data=orders_page_data(status_filter, type_filter, direction, cursor_id)
+            )
         ])
         
         keyboard_buttons.append([
-            InlineKeyboardButton(text="🔙 Назад в админку", callback_data="admin_back")
+            InlineKeyboardButton(text="🔙 Назад в админку", callback_data=cb("admin_back"))
         ])
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -884,40 +2601,30 @@ async def admin_active_orders_handler(callback: types.CallbackQuery):
             parse_mode="HTML"
         )
     
-    await callback.answer(f"📊 Загружено {len(orders)} заказов")
+    await callback.answer(f"📊 Активных заказов: {total}")
 
-@dp.callback_query(F.data.startswith("manage_order_"))
-async def manage_order_handler(callback: types.CallbackQuery):
+@callback_action("manage_order", "mo", digits)
+async def manage_order_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
     try:
-        order_id = int(callback.data.replace("manage_order_", ""))
-        
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         
         if not order:
             await callback.answer("❌ Заказ не найден")
             return
         
-        user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-        
-        details_dict = {}
-        try:
-            if details:
-                details_dict = json.loads(details)
-        except:
-            pass
-        
-        photo_file_id = details_dict.get("payment_photo") if details_dict else None
+        status = order.status
+        photo_file_id = order.payment_photo
         
         if photo_file_id and status in ["waiting_confirmation", "confirmed"]:
             try:
                 photo_caption = f"<b>📸 Фото оплаты заказа #{order_id}</b>\n\n"
                 photo_caption += f"<b>🆔 Заказ:</b> #{order_id}\n"
-                photo_caption += f"<b>📦 Тип:</b> {order_type}\n"
-                photo_caption += f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB"
+                photo_caption += f"<b>📦 Тип:</b> {order.order_type}\n"
+                photo_caption += f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB"
                 
                 await bot.send_photo(
                     callback.message.chat.id,
@@ -931,27 +2638,24 @@ async def manage_order_handler(callback: types.CallbackQuery):
         caption = f"<b>🛠️ Управление заказом #{order_id}</b>\n\n"
         
         caption += f"<b>👤 Покупатель:</b>\n"
-        caption += f"   <b>ID:</b> {user_id}\n"
+        caption += f"   <b>ID:</b> {order.user_id}\n"
         
         caption += f"\n<b>📦 Детали заказа:</b>\n"
-        caption += f"   <b>Тип:</b> {order_type}\n"
-        
-        if order_type == "stars":
-            stars = details_dict.get("stars", 0)
-            caption += f"   <b>⭐️ Звезд:</b> {stars}\n"
-        elif order_type == "premium":
-            period = details_dict.get("period", "")
-            period_name = PREMIUM_PRICES.get(period, {}).get("name", "")
+        caption += f"   <b>Тип:</b> {order.order_type}\n"
+        
+        if order.order_type == "stars":
+            caption += f"   <b>⭐️ Звезд:</b> {order.stars or 0}\n"
+        elif order.order_type == "premium":
+            period_name = PREMIUM_PRICES.get(order.period, {}).get("name", "")
             caption += f"   <b>👑 Период:</b> {period_name}\n"
-        elif order_type == "exchange":
-            amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-            caption += f"   <b>💸 К выдаче:</b> {amount_usd:.2f} USD\n"
+        elif order.order_type == "exchange":
+            caption += f"   <b>💸 К выдаче:</b> {order.amount_usd or 0:.2f} USD\n"
         
-        if recipient:
-            caption += f"   <b>👤 Получатель:</b> @{recipient}\n"  # Добавлен @ перед юзернеймом
+        if order.recipient:
+            caption += f"   <b>👤 Получатель:</b> @{order.recipient}\n"  # Добавлен @ перед юзернеймом
         
-        caption += f"   <b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
-        caption += f"   <b>💳 Метод:</b> {payment_method}\n"
+        caption += f"   <b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n"
+        caption += f"   <b>💳 Метод:</b> {order.payment_method}\n"
         caption += f"   <b>📊 Статус:</b> {status}\n"
         
         if photo_file_id:
@@ -959,40 +2663,46 @@ async def manage_order_handler(callback: types.CallbackQuery):
         else:
             caption += f"   <b>📸 Фото оплаты:</b> ❌ Нет\n"
         
+        events = await db.get_order_events(order_id)
+        if events:
+            caption += f"\n<b>🕓 История:</b>\n"
+            for from_status, to_status, actor, created_at in events:
+                caption += f"   {str(created_at)[5:16]} {from_status} → {to_status} ({actor or '—'})\n"
+        
         keyboard_buttons = []
         
         if status == "waiting_confirmation":
             keyboard_buttons.append([
-                InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"admin_confirm_payment_{order_id}")
+                InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=cb("admin_confirm_payment", order_id))
             ])
             keyboard_buttons.append([
-                InlineKeyboardButton(text="❌ Отклонить заказ", callback_data=f"admin_reject_order_{order_id}")
+                InlineKeyboardButton(text="❌ Отклонить заказ", callback_data=cb("admin_reject_order", order_id))
             ])
         
         elif status == "waiting_crypto":
             keyboard_buttons.append([
-                InlineKeyboardButton(text="💎 Проверить оплату", callback_data=f"check_crypto_{order_id}")
+                InlineKeyboardButton(text="💎 Проверить оплату", callback_data=cb("check_crypto", order_id))
             ])
             keyboard_buttons.append([
-                InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"admin_reject_order_{order_id}")
+                InlineKeyboardButton(text="❌ Отменить заказ", callback_data=cb("admin_reject_order", order_id))
             ])
         
         elif status == "confirmed":
             keyboard_buttons.append([
-                InlineKeyboardButton(text="📦 Я передал товар", callback_data=f"admin_delivered_{order_id}")
+                InlineKeyboardButton(text="📦 Я передал товар", callback_data=cb("admin_delivered", order_id))
             ])
         
         else:
             keyboard_buttons.append([
-                InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"admin_confirm_payment_{order_id}")
+                InlineKeyboardButton(text="✅ Подтвердить", callback_data=cb("admin_confirm_payment", order_id))
             ])
             keyboard_buttons.append([
-                InlineKeyboardButton(text="❌ Отменить", callback_data=f"admin_reject_order_{order_id}")
+                InlineKeyboardButton(text="❌ Отменить", callback_data=cb("admin_reject_order", order_id))
             ])
         
         keyboard_buttons.append([
-            InlineKeyboardButton(text="🔄 Обновить", callback_data=f"manage_order_{order_id}"),
-            InlineKeyboardButton(text="📦 К заказам", callback_data="admin_active_orders")
+            InlineKeyboardButton(text="🔄 Обновить", callback_data=cb("manage_order", order_id)),
+            InlineKeyboardButton(text="📦 К заказам", callback_data=cb("admin_active_orders"))
         ])
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -1004,23 +2714,50 @@ async def manage_order_handler(callback: types.CallbackQuery):
         )
         await callback.answer("✅ Информация о заказе загружена")
         
-    except ValueError as e:
-        await callback.answer("❌ Ошибка: неверный ID заказа")
     except Exception as e:
         await callback.answer("❌ Произошла ошибка")
 
-@dp.callback_query(F.data.startswith("admin_confirm_payment_"))
-async def admin_confirm_payment_handler(callback: types.CallbackQuery):
+def invalid_transition_text(from_status, to_status):
+    return f"⛔ Недопустимый переход: {from_status} → {to_status}"
+
+async def confirmed_admin_status(admin_id, order_id):
+    """Статус заказа на момент первого шага подтверждения (None, если подтверждение не найдено)"""
+    confirmation = await admin_confirmations.get(admin_id)
+    if confirmation and confirmation.get("order_id") == order_id:
+        return confirmation.get("status")
+    return None
+
+async def transition_failure_text(order_id, status, expected_status):
+    """Отличает гонку (статус уже сменил кто-то другой) от перехода, запрещённого ORDER_TRANSITIONS"""
+    order = await db.get_order(order_id)
+    if order is None:
+        return "❌ Заказ не найден"
+    if expected_status is not None and order.status != expected_status:
+        return "⚠️ Заказ уже обработан"
+    if status not in ORDER_TRANSITIONS.get(order.status, ()):
+        return invalid_transition_text(order.status, status)
+    return "⚠️ Заказ уже обработан"
+
+@callback_action("admin_confirm_payment", "ac", digits)
+async def admin_confirm_payment_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_confirm_payment_", ""))
+    order = await db.get_order(order_id)
+    if not order:
+        await callback.answer("❌ Заказ не найден")
+        return
+    if "confirmed" not in ORDER_TRANSITIONS.get(order.status, ()):
+        await callback.answer(invalid_transition_text(order.status, "confirmed"), show_alert=True)
+        return
     
-    admin_confirmations[callback.from_user.id] = {
+    # Статус, который видел админ: финальное подтверждение сработает, только если он не изменился
+    await admin_confirmations.set(callback.from_user.id, {
         "action": "confirm_payment",
-        "order_id": order_id
-    }
+        "order_id": order_id,
+        "status": order.status
+    })
     
     caption = (
         f"<b>⚠️ ВНИМАНИЕ!</b>\n\n"
@@ -1033,8 +2770,8 @@ async def admin_confirm_payment_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ ДА, я всё проверил и подтверждаю", callback_data=f"admin_final_confirm_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="✅ ДА, я всё проверил и подтверждаю", callback_data=cb("admin_final_confirm", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=cb("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -1044,47 +2781,54 @@ async def admin_confirm_payment_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("admin_final_confirm_"))
-async def admin_final_confirm_handler(callback: types.CallbackQuery):
+@callback_action("admin_final_confirm", "fc", digits)
+async def admin_final_confirm_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_confirm_", ""))
-    
-    db.update_order_status(order_id, "confirmed")
+    # Заказ мог уже обработать другой админ (или другой воркер)
+    expected_status = await confirmed_admin_status(callback.from_user.id, order_id)
+    if not await db.update_order_status(order_id, "confirmed", expected_status, actor=f"admin:{callback.from_user.id}"):
+        await admin_confirmations.delete(callback.from_user.id)
+        await callback.answer(await transition_failure_text(order_id, "confirmed", expected_status), show_alert=True)
+        await admin_active_orders_handler(callback)
+        return
     
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"✅ <b>Ваш заказ #{order_id} подтвержден!</b>\n\n"
-                f"Товар будет отправлен в течение 15 минут - 3 часа.",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+        notifier.send_message(
+            order.user_id,
+            f"✅ <b>Ваш заказ #{order_id} подтвержден!</b>\n\n"
+            f"Товар будет отправлен в течение 15 минут - 3 часа.",
+            parse_mode="HTML"
+        )
     
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmations.delete(callback.from_user.id)
     
     await callback.answer("✅ Заказ подтвержден!")
     await admin_active_orders_handler(callback)
 
-@dp.callback_query(F.data.startswith("admin_reject_order_"))
-async def admin_reject_order_handler(callback: types.CallbackQuery):
+@callback_action("admin_reject_order", "ar", digits)
+async def admin_reject_order_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_reject_order_", ""))
+    order = await db.get_order(order_id)
+    if not order:
+        await callback.answer("❌ Заказ не найден")
+        return
+    if "cancelled" not in ORDER_TRANSITIONS.get(order.status, ()):
+        await callback.answer(invalid_transition_text(order.status, "cancelled"), show_alert=True)
+        return
     
-    admin_confirmations[callback.from_user.id] = {
+    # Статус, который видел админ: финальное подтверждение сработает, только если он не изменился
+    await admin_confirmations.set(callback.from_user.id, {
         "action": "reject_order",
-        "order_id": order_id
-    }
+        "order_id": order_id,
+        "status": order.status
+    })
     
     caption = (
         f"<b>⚠️ ВНИМАНИЕ!</b>\n\n"
@@ -1097,8 +2841,8 @@ async def admin_reject_order_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ ДА, отклоняю заказ", callback_data=f"admin_final_reject_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="❌ ДА, отклоняю заказ", callback_data=cb("admin_final_reject", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=cb("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -1108,47 +2852,60 @@ async def admin_reject_order_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("admin_final_reject_"))
-async def admin_final_reject_handler(callback: types.CallbackQuery):
+@callback_action("admin_final_reject", "fr", digits)
+async def admin_final_reject_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_reject_", ""))
-    
-    db.update_order_status(order_id, "cancelled")
+    # Заказ мог уже обработать другой админ (или другой воркер)
+    expected_status = await confirmed_admin_status(callback.from_user.id, order_id)
+    if expected_status is None:
+        order = await db.get_order(order_id)
+        expected_status = order.status if order else None
+    if not await db.update_order_status(order_id, "cancelled", expected_status, actor=f"admin:{callback.from_user.id}"):
+        await admin_confirmations.delete(callback.from_user.id)
+        await callback.answer(await transition_failure_text(order_id, "cancelled", expected_status), show_alert=True)
+        await admin_active_orders_handler(callback)
+        return
     
-    order = db.get_order(order_id)
+    # Счёт перечитывается после отмены: пока заказ был в waiting_crypto, его могли перевыставить
+    order = await db.get_order(order_id)
     if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"❌ <b>Ваш заказ #{order_id} отклонен.</b>\n\n"
-                f"По вопросам обращайтесь в поддержку.",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+        if expected_status == "waiting_crypto":
+            await release_crypto_invoice(order)
+        notifier.send_message(
+            order.user_id,
+            f"❌ <b>Ваш заказ #{order_id} отклонен.</b>\n\n"
+            f"По вопросам обращайтесь в поддержку.",
+            parse_mode="HTML"
+        )
     
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmations.delete(callback.from_user.id)
     
     await callback.answer("❌ Заказ отклонен")
     await admin_active_orders_handler(callback)
 
-@dp.callback_query(F.data.startswith("admin_delivered_"))
-async def admin_delivered_handler(callback: types.CallbackQuery):
+@callback_action("admin_delivered", "ad", digits)
+async def admin_delivered_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_delivered_", ""))
+    order = await db.get_order(order_id)
+    if not order:
+        await callback.answer("❌ Заказ не найден")
+        return
+    if "completed" not in ORDER_TRANSITIONS.get(order.status, ()):
+        await callback.answer(invalid_transition_text(order.status, "completed"), show_alert=True)
+        return
     
-    admin_confirmations[callback.from_user.id] = {
+    # Статус, который видел админ: финальное подтверждение сработает, только если он не изменился
+    await admin_confirmations.set(callback.from_user.id, {
         "action": "delivered",
-        "order_id": order_id
-    }
+        "order_id": order_id,
+        "status": order.status
+    })
     
     caption = (
         f"<b>⚠️ ПОДТВЕРЖДЕНИЕ ПЕРЕДАЧИ</b>\n\n"
@@ -1161,8 +2918,8 @@ async def admin_delivered_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ ДА, товар передан", callback_data=f"admin_final_delivered_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="✅ ДА, товар передан", callback_data=cb("admin_final_delivered", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=cb("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -1172,43 +2929,42 @@ async def admin_delivered_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("admin_final_delivered_"))
-async def admin_final_delivered_handler(callback: types.CallbackQuery):
+@callback_action("admin_final_delivered", "fd", digits)
+async def admin_final_delivered_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_delivered_", ""))
-    
-    db.update_order_status(order_id, "completed")
+    # Заказ мог уже обработать другой админ (или другой воркер)
+    expected_status = await confirmed_admin_status(callback.from_user.id, order_id)
+    if not await db.update_order_status(order_id, "completed", expected_status, actor=f"admin:{callback.from_user.id}"):
+        await admin_confirmations.delete(callback.from_user.id)
+        await callback.answer(await transition_failure_text(order_id, "completed", expected_status), show_alert=True)
+        await admin_active_orders_handler(callback)
+        return
     
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"🎉 <b>Ваш заказ #{order_id} выполнен!</b>\n\n"
-                f"Спасибо за покупку! 😊",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+        notifier.send_message(
+            order.user_id,
+            f"🎉 <b>Ваш заказ #{order_id} выполнен!</b>\n\n"
+            f"Спасибо за покупку! 😊",
+            parse_mode="HTML"
+        )
     
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmations.delete(callback.from_user.id)
     
     await callback.answer("✅ Заказ выполнен!")
     await admin_active_orders_handler(callback)
 
-@dp.callback_query(F.data == "admin_stats")
+@callback_action("admin_stats", "as")
 async def admin_stats_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_active_orders()
-    active_count = len(orders)
+    stats = await db.get_stats()
+    active_count = stats["active_orders"]
     
     caption = (
         f"<b>📊 Статистика магазина</b>\n\n"
@@ -1216,8 +2972,8 @@ async def admin_stats_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=cb("admin_stats"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("admin_back"))]
     ])
     
     await callback.message.edit_text(
@@ -1227,7 +2983,7 @@ async def admin_stats_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_back")
+@callback_action("admin_back", "ak")
 async def admin_back_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
@@ -1243,90 +2999,44 @@ async def admin_back_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ОБРАБОТКА ФОТО ОПЛАТЫ ==========
-@dp.message(F.photo)
+@on_message(F.photo)
 async def handle_payment_photo(message: types.Message):
     user_id = message.from_user.id
     
-    if user_id not in user_states:
+    state = await user_states.get(user_id)
+    
+    if state is None:
         await message.answer("Пожалуйста, используйте кнопки меню.")
         return
     
-    state = user_states[user_id]
-    
     if state.get("action") == "waiting_payment_photo":
         order_id = state.get("order_id")
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         
         if not order:
             await message.answer("❌ Заказ не найден")
             return
         
-        user_id_db, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-        
         photo_file_id = message.photo[-1].file_id
         
-        try:
-            details_dict = json.loads(details) if details else {}
-            details_dict["payment_photo"] = photo_file_id
-            db.add_payment_photo(order_id, photo_file_id)
-        except:
-            pass
-        
-        db.update_order_status(order_id, "waiting_confirmation")
+        await user_states.delete(user_id)
         
-        del user_states[user_id]
+        # Повторное фото или уже обработанный заказ: админов второй раз не уведомляем
+        if not await db.update_order_status(order_id, "waiting_confirmation", "waiting_payment", actor="user"):
+            await message.answer("ℹ️ Заказ уже передан на проверку или обработан.")
+            await show_main_menu(message)
+            return
         
-        for admin_id in ADMIN_IDS:
-            try:
-                photo_caption = f"<b>📸 Новое фото оплаты | Заказ #{order_id}</b>"
-                
-                await bot.send_photo(
-                    admin_id,
-                    photo=photo_file_id,
-                    caption=photo_caption,
-                    parse_mode="HTML"
-                )
-                
-                admin_message = f"<b>🆕 Новый заказ ожидает проверки</b>\n\n"
-                admin_message += f"<b>🆔 Заказ:</b> #{order_id}\n"
-                admin_message += f"<b>👤 Пользователь:</b> {message.from_user.username or 'Нет юзернейма'}\n"
-                admin_message += f"<b>🆔 ID:</b> {message.from_user.id}\n"
-                admin_message += f"<b>📦 Тип:</b> {order_type}\n"
-                admin_message += f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        admin_message += f"<b>💸 К выдаче:</b> {amount_usd:.2f} USD\n"
-                    except:
-                        pass
-                else:
-                    admin_message += f"<b>👤 Получатель:</b> @{recipient}\n"  # Добавлен @ перед юзернеймом
-                
-                admin_message += f"\n<b>Для проверки зайдите в /admin → 📦 Активные заказы</b>"
-                
-                await bot.send_message(admin_id, admin_message, parse_mode="HTML")
-                
-            except Exception as e:
-                pass
+        await db.add_payment_photo(order_id, photo_file_id)
         
-        if order_type == "exchange":
-            try:
-                details_dict = json.loads(details) if details else {}
-                amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                user_message = (
-                    f"✅ <b>Фото оплаты получено!</b>\n"
-                    f"<b>💸 Вы получаете:</b> {amount_usd:.2f} USD\n"
-                    f"<b>💰 Оплачено:</b> {amount_rub:.2f} RUB\n\n"
-                    "Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
-            except:
-                user_message = (
-                    "✅ <b>Фото оплаты получено!</b> Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
+        if order.order_type == "exchange":
+            user_message = (
+                f"✅ <b>Фото оплаты получено!</b>\n"
+                f"<b>💸 Вы получаете:</b> {order.amount_usd or 0:.2f} USD\n"
+                f"<b>💰 Оплачено:</b> {order.amount_rub:.2f} RUB\n\n"
+                "Заказ передан админу на проверку.\n"
+                "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
+            )
         else:
             user_message = (
                 "✅ <b>Фото оплаты получено!</b> Заказ передан админу на проверку.\n"
@@ -1335,25 +3045,49 @@ async def handle_payment_photo(message: types.Message):
         
         await message.answer(user_message, parse_mode="HTML")
         await show_main_menu(message)
+        
+        photo_caption = f"<b>📸 Новое фото оплаты | Заказ #{order_id}</b>"
+        
+        admin_message = f"<b>🆕 Новый заказ ожидает проверки</b>\n\n"
+        admin_message += f"<b>🆔 Заказ:</b> #{order_id}\n"
+        admin_message += f"<b>👤 Пользователь:</b> {message.from_user.username or 'Нет юзернейма'}\n"
+        admin_message += f"<b>🆔 ID:</b> {message.from_user.id}\n"
+        admin_message += f"<b>📦 Тип:</b> {order.order_type}\n"
+        admin_message += f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n"
+        
+        if order.order_type == "exchange":
+            admin_message += f"<b>💸 К выдаче:</b> {order.amount_usd or 0:.2f} USD\n"
+        else:
+            admin_message += f"<b>👤 Получатель:</b> @{order.recipient}\n"  # Добавлен @ перед юзернеймом
+        
+        admin_message += f"\n<b>Для проверки зайдите в /admin → 📦 Активные заказы</b>"
+        
+        # Админам — через очередь, пользователь получил ответ выше и не ждёт доставки
+        notifier.notify_admins(
+            lambda admin_id: SendPhoto(chat_id=admin_id, photo=photo_file_id, caption=photo_caption, parse_mode="HTML"),
+            lambda admin_id: SendMessage(chat_id=admin_id, text=admin_message, parse_mode="HTML")
+        )
 
 # ========== ОПЛАТА КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("card_pay_"))
-async def card_payment_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("card_pay_", ""))
-    order = db.get_order(order_id)
+@callback_action("card_pay", "cp", digits)
+async def card_payment_handler(callback: types.CallbackQuery, order_id: int):
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-    
-    db.update_order_status(order_id, "waiting_payment")
+    if order.status != "waiting_payment":
+        if not await db.update_order_status(order_id, "waiting_payment", order.status, actor="user"):
+            await callback.answer("ℹ️ Заказ уже оплачен или закрыт", show_alert=True)
+            return
+        if order.status == "waiting_crypto":
+            await release_crypto_invoice(await db.get_order(order_id) or order)
     
     caption = (
         f"<b>💳 Оплата картой</b>\n\n"
         f"<b>🆔 Заказ:</b> #{order_id}\n"
-        f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n\n"
+        f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n\n"
         f"<b>Реквизиты для перевода:</b>\n"
         f"{CARD_NUMBER}\n\n"
         "<b>Инструкция:</b>\n"
@@ -1373,37 +3107,69 @@ async def card_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ОПЛАТА CRYPTOBOT ==========
-@dp.callback_query(F.data.startswith("crypto_pay_"))
-async def crypto_payment_handler(callback: types.CallbackQuery):
+@callback_action("crypto_pay", "kp", digits)
+async def crypto_payment_handler(callback: types.CallbackQuery, order_id: int):
     if not cryptobot:
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("crypto_pay_", ""))
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
+    # Повторное нажатие в waiting_crypto не меняет статус
+    in_crypto = order.status == "waiting_crypto"
+    if not in_crypto and "waiting_crypto" not in ORDER_TRANSITIONS.get(order.status, ()):
+        await callback.answer("ℹ️ Заказ уже оплачен или закрыт", show_alert=True)
+        return
     
-    result = await cryptobot.create_invoice(
-        amount=amount_rub,
-        description=f"Заказ #{order_id} | {order_type}"
-    )
+    # Действующий счёт заказа отдаётся повторно, просроченная ссылка — никогда
+    invoice_alive = bool(order.invoice_url) and time.time() < order.invoice_expires_at
+    if in_crypto and order.invoice_url and not invoice_alive:
+        # Срок по нашим часам вышел: узнаём у CryptoBot, чем кончился счёт. Оплаченный подтверждается,
+        # истёкший отменяет заказ — это делает проверка оплаты
+        status = await cryptobot.check_invoice_status(order.invoice_id)
+        if not status["success"] or status["status"] != "active":
+            await check_crypto_payment(callback, order_id)
+            return
+        # Часы CryptoBot отстают от наших — счёт ещё можно оплатить
+        invoice_alive = True
+    
+    amount_rub = order.amount_rub
+    actor = "user"
+    if invoice_alive:
+        result = {"success": True, "pay_url": order.invoice_url, "amount": order.invoice_amount}
+        saved = in_crypto or await db.update_order_status(order_id, "waiting_crypto", actor=actor)
+    else:
+        result = await cryptobot.create_invoice(
+            amount_usdt=rates.rub_to_usdt(amount_rub),
+            description=f"Заказ #{order_id} | {order.order_type}",
+            payload=f"order_{order_id}"
+        )
+        saved = result["success"] and await db.update_invoice(
+            order_id, result["invoice_id"], result["pay_url"], result["amount"], result["expires_at"],
+            previous_invoice_id=order.invoice_id, actor=actor
+        )
+        if result["success"] and not saved:
+            # Заказ закрыли или параллельное нажатие уже записало свой счёт: оплатить этот не должно быть возможно
+            await cryptobot.delete_invoice(result["invoice_id"])
+            current = await db.get_order(order_id)
+            if current and current.status == "waiting_crypto" and current.invoice_url:
+                result = {"success": True, "pay_url": current.invoice_url, "amount": current.invoice_amount}
+                saved = True
     
     if result["success"]:
-        db.update_invoice_id(order_id, result["invoice_id"])
-        db.update_order_status(order_id, "waiting_crypto")
-        
-        amount_usdt = amount_rub / 85.0
+        if not saved:
+            await callback.answer("ℹ️ Заказ уже оплачен или закрыт", show_alert=True)
+            return
         
         caption = (
             f"<b>💎 Оплата через CryptoBot</b>\n\n"
             f"<b>🆔 Заказ:</b> #{order_id}\n"
             f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
-            f"<b>💱 К оплате:</b> {amount_usdt:.2f} USDT\n\n"
+            f"<b>💱 К оплате:</b> {float(result['amount']):.2f} USDT\n\n"
             "<b>Для оплаты:</b>\n"
             "1. Нажмите кнопку ниже\n"
             "2. Оплатите счет в CryptoBot\n"
@@ -1413,8 +3179,8 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💎 Оплатить в CryptoBot", url=result["pay_url"])],
-            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=f"check_crypto_{order_id}")],
-            [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=cb("check_crypto", order_id))],
+            [InlineKeyboardButton(text="🔙 Главное меню", callback_data=cb("main_menu"))]
         ])
         
         await callback.message.edit_text(
@@ -1428,78 +3194,133 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ПРОВЕРКА CRYPTOBOT ОПЛАТЫ ==========
-@dp.callback_query(F.data.startswith("check_crypto_"))
-async def check_crypto_payment(callback: types.CallbackQuery):
+def notify_crypto_paid(order: Order):
+    admin_message = (
+        f"<b>💎 CryptoBot оплата ПОДТВЕРЖДЕНА</b>\n\n"
+        f"<b>🆔 Заказ:</b> #{order.id}\n"
+        f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n"
+        f"<b>📦 Тип:</b> {order.order_type}\n"
+    )
+    
+    if order.order_type != "exchange":
+        admin_message += f"<b>👤 Получатель:</b> @{order.recipient}\n"  # Добавлен @ перед юзернеймом
+    
+    admin_message += f"\n<b>✅ Статус:</b> ОПЛАЧЕНО\n"
+    admin_message += f"<b>👨‍💼 Перейдите в админ панель для выполнения заказа</b>"
+    
+    notifier.notify_admins(
+        lambda admin_id: SendMessage(chat_id=admin_id, text=admin_message, parse_mode="HTML")
+    )
+    
+    notifier.send_message(
+        order.user_id,
+        f"✅ <b>Оплата подтверждена!</b>\n\n"
+        f"<b>🆔 Ваш заказ:</b> #{order.id}\n"
+        f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n\n"
+        f"Товар будет отправлен в течение 15 минут - 3 часа!",
+        parse_mode="HTML"
+    )
+
+def notify_crypto_expired(order_id, user_id):
+    notifier.send_message(
+        user_id,
+        f"❌ <b>Счет просрочен!</b>\n\nЗаказ #{order_id} отменен.",
+        parse_mode="HTML"
+    )
+
+def notify_crypto_mismatch(order: Order, status):
+    """Счёт оплачен, а заказ уже не ждёт крипто-оплаты — деньги пришли мимо заказа"""
+    admin_message = (
+        f"<b>⚠️ CryptoBot счёт оплачен, но заказ не ожидает оплаты</b>\n\n"
+        f"<b>🆔 Заказ:</b> #{order.id}\n"
+        f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n"
+        f"<b>🧾 Счёт:</b> {order.invoice_id}\n"
+        f"<b>📌 Статус заказа:</b> {status}\n\n"
+        f"<b>Проверьте платёж вручную</b>"
+    )
+    notifier.notify_admins(
+        lambda admin_id: SendMessage(chat_id=admin_id, text=admin_message, parse_mode="HTML")
+    )
+
+async def release_crypto_invoice(order: Order):
+    """Удаляет счёт заказа, который ушёл из waiting_crypto не в confirmed, чтобы его нельзя было оплатить.
+    Если счёт успели оплатить, об этом узнают админы"""
+    if not cryptobot or not order.invoice_id:
+        return
+    
+    await db.clear_invoice(order.id, order.invoice_id)
+    if await cryptobot.delete_invoice(order.invoice_id):
+        return
+    
+    result = await cryptobot.check_invoice_status(order.invoice_id)
+    if result["success"] and result["status"] == "paid":
+        current = await db.get_order(order.id)
+        notify_crypto_mismatch(order, current.status if current else "удалён")
+    elif not result["success"] or result["status"] == "active":
+        logger.warning(f"Не удалось удалить счёт {order.invoice_id} заказа #{order.id}")
+
+def crypto_paid_caption(order_id, amount_rub):
+    return (
+        f"<b>💎 Оплата подтверждена!</b>\n\n"
+        f"<b>🆔 Заказ:</b> #{order_id}\n"
+        f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
+        f"<b>✅ Статус:</b> ОПЛАЧЕНО\n\n"
+        f"Админ уведомлен о платеже. Товар будет отправлен в течение 15 минут - 3 часа!"
+    )
+
+@callback_action("check_crypto", "kc", digits)
+async def check_crypto_payment(callback: types.CallbackQuery, order_id: int):
     if not cryptobot:
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("check_crypto_", ""))
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=cb("main_menu"))]
+    ])
+    
+    # Фоновая сверка могла уже подтвердить заказ — повторно в API не ходим
+    if order.status in ("confirmed", "completed"):
+        await callback.message.edit_text(
+            text=crypto_paid_caption(order_id, order.amount_rub),
+            reply_markup=keyboard,
+            parse_mode="HTML"
+        )
+        await callback.answer()
+        return
     
-    if not invoice_id:
+    if not order.invoice_id:
         await callback.answer("❌ Нет invoice_id для проверки")
         return
     
     await callback.answer("🔍 Проверяем оплату...")
     
-    result = await cryptobot.check_invoice_status(invoice_id)
+    result = await cryptobot.check_invoice_status(order.invoice_id)
     
     if result["success"]:
         if result["status"] == "paid":
-            db.update_order_status(order_id, "confirmed")
-            
-            for admin_id in ADMIN_IDS:
-                try:
-                    admin_message = (
-                        f"<b>💎 CryptoBot оплата ПОДТВЕРЖДЕНА</b>\n\n"
-                        f"<b>🆔 Заказ:</b> #{order_id}\n"
-                        f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
-                        f"<b>📦 Тип:</b> {order_type}\n"
+            if await db.update_order_status(order_id, "confirmed", "waiting_crypto", actor="cryptobot"):
+                notify_crypto_paid(order)
+            else:
+                # Заказ успели отклонить или перевести на карту — «оплачено» показываем, только если это правда
+                current = await db.get_order(order_id)
+                status = current.status if current else "удалён"
+                if status not in PAID_STATUSES:
+                    notify_crypto_mismatch(order, status)
+                    await callback.answer(
+                        f"⚠️ Оплата получена, но заказ #{order_id} уже закрыт.\n"
+                        "Админ уведомлен и свяжется с вами.",
+                        show_alert=True
                     )
-                    
-                    if order_type != "exchange":
-                        admin_message += f"<b>👤 Получатель:</b> @{recipient}\n"  # Добавлен @ перед юзернеймом
-                    
-                    admin_message += f"\n<b>✅ Статус:</b> ОПЛАЧЕНО\n"
-                    admin_message += f"<b>👨‍💼 Перейдите в админ панель для выполнения заказа</b>"
-                    
-                    await bot.send_message(admin_id, admin_message, parse_mode="HTML")
-                except:
-                    pass
-            
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ <b>Оплата подтверждена!</b>\n\n"
-                    f"<b>🆔 Ваш заказ:</b> #{order_id}\n"
-                    f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n\n"
-                    f"Товар будет отправлен в течение 15 минут - 3 часа!",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            
-            caption = (
-                f"<b>💎 Оплата подтверждена!</b>\n\n"
-                f"<b>🆔 Заказ:</b> #{order_id}\n"
-                f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n"
-                f"<b>✅ Статус:</b> ОПЛАЧЕНО\n\n"
-                f"Админ уведомлен о платеже. Товар будет отправлен в течение 15 минут - 3 часа!"
-            )
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-            ])
+                    return
             
             await callback.message.edit_text(
-                text=caption,
+                text=crypto_paid_caption(order_id, order.amount_rub),
                 reply_markup=keyboard,
                 parse_mode="HTML"
             )
@@ -1511,12 +3332,9 @@ async def check_crypto_payment(callback: types.CallbackQuery):
             )
             
         elif result["status"] == "expired":
-            db.update_order_status(order_id, "cancelled")
+            await db.update_order_status(order_id, "cancelled", "waiting_crypto", actor="cryptobot")
             
             caption = f"❌ <b>Счет просрочен!</b>\n\nЗаказ #{order_id} отменен."
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-            ])
             
             await callback.message.edit_text(
                 text=caption,
@@ -1530,69 +3348,107 @@ async def check_crypto_payment(callback: types.CallbackQuery):
             show_alert=True
         )
 
+# ========== ФОНОВАЯ СВЕРКА CRYPTOBOT СЧЕТОВ ==========
+async def reconcile_crypto_invoices():
+    """Одна проверка всех заказов в waiting_crypto пачками запросов getInvoices"""
+    orders = await db.get_orders_by_status("waiting_crypto")
+    orders = [order for order in orders if order.invoice_id]
+    
+    if not orders:
+        return
+    
+    invoices = await cryptobot.get_invoices([order.invoice_id for order in orders])
+    
+    paid, expired = [], []
+    for order in orders:
+        invoice = invoices.get(str(order.invoice_id))
+        if not invoice:
+            continue
+        if invoice["status"] == "paid":
+            paid.append(order)
+        elif invoice["status"] == "expired":
+            expired.append(order)
+    
+    if paid:
+        confirmed_ids = set(await db.update_orders_status([order.id for order in paid], "confirmed", "waiting_crypto", actor="reconciler"))
+        for order in paid:
+            if order.id in confirmed_ids:
+                notify_crypto_paid(order)
+    
+    if expired:
+        cancelled_ids = set(await db.update_orders_status([order.id for order in expired], "cancelled", "waiting_crypto", actor="reconciler"))
+        for order in expired:
+            if order.id in cancelled_ids:
+                notify_crypto_expired(order.id, order.user_id)
+    
+    if paid or expired:
+        logger.info(f"Сверка CryptoBot: оплачено {len(paid)}, просрочено {len(expired)}")
+
+async def crypto_reconciler_loop(interval=CRYPTO_POLL_INTERVAL):
+    while True:
+        try:
+            await reconcile_crypto_invoices()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Ошибка сверки CryptoBot: {e}")
+        
+        await asyncio.sleep(interval)
+
 # ========== ПОДТВЕРЖДЕНИЕ ОПЛАТЫ КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("confirm_paid_"))
-async def confirm_card_payment(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("confirm_paid_", ""))
-    order = db.get_order(order_id)
+@callback_action("confirm_paid", "pd", digits)
+async def confirm_card_payment(callback: types.CallbackQuery, order_id: int):
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-    
-    user_states[callback.from_user.id] = {
+    await user_states.set(callback.from_user.id, {
         "action": "waiting_payment_photo",
         "order_id": order_id
-    }
+    })
     
     await callback.message.edit_text(
         f"<b>📸 Пришлите фото/скриншот оплаты</b>\n\n"
         f"<b>🆔 Заказ:</b> #{order_id}\n"
-        f"<b>💰 Сумма:</b> {amount_rub:.2f} RUB\n\n"
+        f"<b>💰 Сумма:</b> {order.amount_rub:.2f} RUB\n\n"
         "Пожалуйста, отправьте скриншот перевода.\n"
         "После отправки фото заказ будет передан админу на проверку.",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=cb("cancel_photo", order_id))]
         ]),
         parse_mode="HTML"
     )
     
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("cancel_photo_"))
-async def cancel_photo_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("cancel_photo_", ""))
+@callback_action("cancel_photo", "cx", digits)
+async def cancel_photo_handler(callback: types.CallbackQuery, order_id: int):
+    await user_states.delete(callback.from_user.id)
     
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
-    
-    await card_payment_handler(callback)
+    await card_payment_handler(callback, order_id)
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ==========
-@dp.message(F.text)
+@on_message(F.text)
 async def handle_text_messages(message: types.Message):
     if message.text.startswith('/'):
         return
     
     user_id = message.from_user.id
     
-    if user_id not in ADMIN_IDS and not await check_subscription(user_id):
-        await require_subscription(user_id, message=message)
-        return
+    state = await user_states.get(user_id)
     
-    if user_id in user_states and user_states[user_id].get("action") == "waiting_payment_photo":
+    if state is not None and state.get("action") == "waiting_payment_photo":
         await message.answer("📸 Пожалуйста, отправьте фото/скриншот оплаты")
         return
     
     text = message.text.strip()
     
-    if user_id not in user_states:
+    if state is None:
         await message.answer("Используйте меню", reply_markup=main_menu_kb())
         return
     
-    state = user_states[user_id]
     action = state.get("action")
     
     if action == "waiting_calculation":
@@ -1645,6 +3501,7 @@ async def handle_text_messages(message: types.Message):
         
         state["recipient"] = recipient
         state["action"] = "waiting_stars_amount"
+        await user_states.set(user_id, state)
         
         await message.answer(
             f"✅ <b>Получатель:</b> @{recipient}\n\n"
@@ -1663,23 +3520,22 @@ async def handle_text_messages(message: types.Message):
             amount_rub = stars * STAR_RATE
             recipient = state.get("recipient", "")
             
-            state["stars_amount"] = stars
-            state["amount_rub"] = amount_rub
-            
-            order_id = db.add_order(
-                user_id, "stars", recipient, 
-                json.dumps({"stars": stars}), 
-                amount_rub, "card"
-            )
+            # Шаг завершается вместе с созданием заказа: то же сообщение на другом воркере заказ не повторит
+            order_id = await user_states.consume(user_id, state, partial(
+                db.add_order, user_id, "stars", recipient, amount_rub, "card",
+                stars=stars
+            ))
+            if order_id is None:
+                return
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
+                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=cb("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("buy_stars"))]
             ])
             
             if cryptobot:
                 keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
+                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=cb("crypto_pay", order_id))
                 ])
             
             await message.answer(
@@ -1715,22 +3571,21 @@ async def handle_text_messages(message: types.Message):
         amount_rub = state.get("amount_rub")
         
         if period and amount_rub:
-            state["recipient"] = recipient
-            
-            order_id = db.add_order(
-                user_id, "premium", recipient,
-                json.dumps({"period": period}),
-                amount_rub, "card"
-            )
+            order_id = await user_states.consume(user_id, state, partial(
+                db.add_order, user_id, "premium", recipient, amount_rub, "card",
+                period=period
+            ))
+            if order_id is None:
+                return
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
+                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=cb("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("buy_premium"))]
             ])
             
             if cryptobot:
                 keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
+                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=cb("crypto_pay", order_id))
                 ])
             
             await message.answer(
@@ -1748,26 +3603,24 @@ async def handle_text_messages(message: types.Message):
                 await message.answer("❌ Минимальная сумма: 100 RUB")
                 return
             
-            amount_usd = amount_rub / USD_RATE
+            usd_rate = rates.usd_rub()
+            amount_usd = amount_rub / usd_rate
             
-            order_id = db.add_order(
-                user_id, "exchange", "",
-                json.dumps({
-                    "amount_rub": amount_rub, 
-                    "amount_usd": amount_usd,
-                    "exchange_rate": USD_RATE
-                }),
-                amount_rub, "card"
-            )
+            order_id = await user_states.consume(user_id, state, partial(
+                db.add_order, user_id, "exchange", "", amount_rub, "card",
+                amount_usd=amount_usd, exchange_rate=usd_rate
+            ))
+            if order_id is None:
+                return
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="exchange")]
+                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=cb("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=cb("exchange"))]
             ])
             
             await message.answer(
                 f"✅ <b>Обмен валют</b>\n"
-                f"<b>📊 Курс:</b> 1 USD = {USD_RATE} RUB\n"
+                f"<b>📊 Курс:</b> 1 USD = {usd_rate:.2f} RUB\n"
                 f"<b>💸 Вы получаете:</b> {amount_usd:.2f} USD\n"
                 f"<b>💰 К оплате:</b> {amount_rub:.2f} RUB\n\n"
                 "<b>💳 Оплата только картой!</b>\n"
@@ -1780,6 +3633,223 @@ async def handle_text_messages(message: types.Message):
             await message.answer("❌ Пожалуйста, введите число")
 
 # ========== ЗАПУСК БОТА ==========
+async def on_startup():
+    await notifier.start()
+    if cryptobot:
+        await cryptobot.start()
+    # Курс из БД доступен сразу; свежий запрашивается в фоне, не задерживая старт
+    await rates.load()
+    
+    # Общие для всего бота действия выполняет только ведущий воркер
+    if not IS_LEADER:
+        cold_start.mark_ready()
+        return
+    
+    await setup_menu_button()
+    if cryptobot:
+        background_tasks.append(asyncio.create_task(crypto_reconciler_loop()))
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    else:
+        # Polling не работает при установленном вебхуке (например, после смены режима)
+        await bot.delete_webhook()
+    
+    cold_start.mark_ready()
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    
+    await notifier.stop()
+    await rates.close()
+    if cryptobot:
+        await cryptobot.close()
+
+class ColdStartMiddleware(BaseMiddleware):
+    """Фиксирует время от запуска процесса до первого апдейта (скорость рестарта при деплое)"""
+    
+    def __init__(self):
+        self.ready_after = None
+        self.first_update_after = None
+    
+    def mark_ready(self):
+        self.ready_after = time.monotonic() - STARTED_AT
+        logger.info("Готов к приёму апдейтов через %.3f с после запуска", self.ready_after)
+    
+    async def __call__(self, handler, event: types.Update, data):
+        if self.first_update_after is None:
+            self.first_update_after = time.monotonic() - STARTED_AT
+            logger.info("Первый апдейт через %.3f с после запуска", self.first_update_after)
+        return await handler(event, data)
+
+@dataclass(slots=True)
+class AppConfig:
+    bot_token: str = BOT_TOKEN
+    db_path: str = DB_PATH
+    state_storage: str = STATE_STORAGE
+    cryptobot_token: str = CRYPTOBOT_TOKEN
+    cryptobot_api_url: str = CRYPTOBOT_API_URL
+    telegram_api_url: str = TELEGRAM_API_URL
+
+def create_app(config=None):
+    """Собирает бота, БД, хранилище состояний, клиент CryptoBot и диспетчер.
+    
+    Сервисы привязываются к глобальным именам модуля, которыми пользуются хендлеры,
+    поэтому экземпляры приложения не изолированы: повторный вызов (например, в тестах)
+    заменяет сервисы предыдущего, и тот нужно сначала закрыть через close_app().
+    """
+    global bot, dp, db, cryptobot, rates, state_storage, user_states, admin_confirmations
+    global notifier, subscription_cache, subscription_middleware, user_lanes, throttling, cold_start
+    global background_tasks
+    config = config or AppConfig()
+    
+    # Свой адрес Bot API: локальный telegram-bot-api сервер или фейковый сервер для тестов
+    session = AiohttpSession(api=TelegramAPIServer.from_base(config.telegram_api_url)) if config.telegram_api_url else None
+    bot = Bot(token=config.bot_token, session=session)
+    db = Database(config.db_path)
+    cryptobot = CryptoBotAPI(config.cryptobot_token, base_url=config.cryptobot_api_url) if config.cryptobot_token else None
+    rates = RateService(cryptobot, db)
+    state_storage = SQLiteStateStorage(db) if config.state_storage == "sqlite" else MemoryStateStorage()
+    user_states = StateNamespace(state_storage, "user")
+    admin_confirmations = StateNamespace(state_storage, "admin")
+    notifier = Notifier(bot)
+    subscription_cache = SubscriptionCache()
+    subscription_middleware = SubscriptionMiddleware()
+    user_lanes = UserLaneMiddleware()
+    throttling = ThrottlingMiddleware() if THROTTLE_ENABLED else None
+    cold_start = ColdStartMiddleware()
+    background_tasks = []
+    
+    dp = Dispatcher()
+    dp.update.outer_middleware(cold_start)
+    if metrics:
+        # Регистрируется раньше проверки подписки, чтобы учитывать и её
+        dp.update.outer_middleware(HandlerMetricsMiddleware(metrics))
+        bot.session.middleware(BotRequestMetricsMiddleware(metrics))
+    # Флуд отбрасывается до очереди пользователя, очередь — до проверки подписки
+    if throttling:
+        dp.update.outer_middleware(throttling)
+    dp.update.outer_middleware(user_lanes)
+    dp.update.outer_middleware(subscription_middleware)
+    
+    for filters, handler in MESSAGE_HANDLERS:
+        dp.message.register(handler, *filters)
+    dp.callback_query.register(callback_router)
+    
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+async def close_app():
+    await bot.session.close()
+    db.close()
+
+# ========== WEBHOOK ==========
+class WebhookRequestHandler(SimpleRequestHandler):
+    async def wait_pending_updates(self, timeout):
+        """Дожидается апдейтов, которые уже приняты и обрабатываются в фоне"""
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+
+async def health_handler(request):
+    return web.json_response({
+        "status": "ok",
+        "mode": "webhook",
+        "uptime": round(time.monotonic() - STARTED_AT, 1),
+        "ready_after": cold_start.ready_after,
+        "first_update_after": cold_start.first_update_after,
+        "notify_queue": notifier.queue.qsize()
+    })
+
+async def metrics_handler(request):
+    extra = {
+        "digistore_uptime_seconds": round(time.monotonic() - STARTED_AT, 1),
+        "digistore_notify_queue_size": notifier.queue.qsize(),
+        "digistore_subscription_cache_size": subscription_cache.stats()["size"],
+        "digistore_subscription_cache_hit_rate": round(subscription_cache.stats()["hit_rate"], 4),
+    }
+    lane_stats = user_lanes.stats()
+    extra.update({
+        "digistore_user_lanes": lane_stats["lanes"],
+        "digistore_user_lane_queued": lane_stats["queued"],
+        "digistore_user_lane_peak_depth": lane_stats["peak_depth"],
+        "digistore_user_lane_waited_total": lane_stats["waited"],
+        "digistore_user_lane_dropped_total": lane_stats["dropped"],
+    })
+    if throttling:
+        throttle_stats = throttling.stats()
+        extra.update({
+            "digistore_updates_inflight": throttle_stats["inflight"],
+            "digistore_throttled_total": throttle_stats["throttled"],
+            "digistore_duplicate_callbacks_total": throttle_stats["duplicates"],
+            "digistore_shed_total": throttle_stats["shed"],
+        })
+    rate_stats = rates.stats()
+    extra["digistore_usd_rub_rate"] = rate_stats["usd_rub"]
+    if rate_stats["age"] is not None:
+        extra["digistore_rate_age_seconds"] = round(rate_stats["age"], 1)
+    if cold_start.first_update_after is not None:
+        extra["digistore_first_update_seconds"] = round(cold_start.first_update_after, 3)
+    text = metrics.render(extra)
+    return web.Response(text=text, content_type="text/plain", headers={"X-Worker-Id": str(WORKER_ID)})
+
+async def start_metrics_server():
+    """Отдельный HTTP-сервер с /metrics для режима polling"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{WEBAPP_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def create_web_app():
+    app = web.Application()
+    app.router.add_get("/health", health_handler)
+    if metrics:
+        app.router.add_get("/metrics", metrics_handler)
+    
+    webhook_handler = WebhookRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+    webhook_handler.register(app, path=WEBHOOK_PATH)
+    app["webhook_handler"] = webhook_handler
+    
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    app = create_web_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT, reuse_port=WORKERS > 1)
+    await site.start()
+    
+    print(f"🌐 Webhook: {WEBHOOK_URL}{WEBHOOK_PATH} (слушаю {WEBAPP_HOST}:{WEBAPP_PORT})")
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    try:
+        await stop_event.wait()
+    finally:
+        print("🛑 Останавливаюсь: перестаю принимать апдейты и дожидаюсь текущих...")
+        # Сначала закрываем приём, затем ждём обработку принятых апдейтов, потом shutdown-хуки
+        await site.stop()
+        await app["webhook_handler"].wait_pending_updates(WEBHOOK_SHUTDOWN_TIMEOUT)
+        await runner.cleanup()
+
 async def main():
     print("=" * 50)
     print("🚀 Digi Store Bot запускается...")
@@ -1790,32 +3860,80 @@ async def main():
         print("ℹ️  Установите переменную окружения BOT_TOKEN")
         exit(1)
     
+    create_app()
+    print(f"⏱ Инициализация: {time.monotonic() - STARTED_AT:.3f} с после запуска процесса")
     print(f"🤖 Бот: ✅ Настроен")
     print(f"👑 Админ ID: {ADMIN_IDS}")
     print(f"💎 CryptoBot: {'✅ Настроен' if CRYPTOBOT_TOKEN else '❌ Нет токена'}")
     print(f"💳 Карта: {CARD_NUMBER}")
     print(f"🆘 Тех поддержка: @{SUPPORT_USER}")
     print(f"📢 Канал: @{CHANNEL_USERNAME} (ID: {CHANNEL_ID})")
+    print(f"💾 Состояния диалогов: {STATE_STORAGE} (TTL {STATE_TTL / 3600:g} ч)")
+    print(f"📡 Режим получения апдейтов: {'webhook' if WEBHOOK_URL else 'long polling'}")
+    if WORKERS > 1:
+        print(f"👷 Воркер: {WORKER_ID + 1}/{WORKERS}{' (ведущий)' if IS_LEADER else ''}")
     print("=" * 50)
-    
-    await setup_menu_button()
-    
     print("✅ Menu button настроен с командой /start")
     print("🔵 Рядом с чатом будет синяя кнопка с командой /start")
-    print("=" * 50)
     print("✅ Бот готов к работе")
     print("ℹ️  Проверка подписки на канал: АКТИВНА")
     print("ℹ️  Админ панель с статистикой: АКТИВНА")
     print("ℹ️  Текст главного меню в цитате: АКТИВНО")
     print("ℹ️  Юзернеймы с @ в админ панели: АКТИВНО")
+    if cryptobot:
+        print(f"ℹ️  Автосверка CryptoBot: каждые {CRYPTO_POLL_INTERVAL:g} сек")
     print("=" * 50)
     
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            metrics_runner = await start_metrics_server() if metrics and METRICS_PORT else None
+            try:
+                await dp.start_polling(bot)
+            finally:
+                if metrics_runner:
+                    await metrics_runner.cleanup()
     except Exception as e:
         print(f"❌ Ошибка: {e}")
     finally:
-        await bot.session.close()
+        await close_app()
+
+def run_worker():
+    asyncio.run(main())
+
+def run_workers():
+    """Запускает WORKERS процессов; каждый импортирует модуль заново (spawn) со своим WORKER_ID"""
+    if not WEBHOOK_URL:
+        print("❌ ОШИБКА: несколько воркеров работают только в режиме webhook (WEBHOOK_URL)")
+        exit(1)
+    if STATE_STORAGE != "sqlite":
+        print("❌ ОШИБКА: для нескольких воркеров нужно STATE_STORAGE=sqlite")
+        exit(1)
+    
+    context = multiprocessing.get_context("spawn")
+    # Секрет вебхука должен совпадать у всех воркеров
+    os.environ["WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    processes = []
+    for worker_id in range(WORKERS):
+        os.environ["WORKER_ID"] = str(worker_id)
+        process = context.Process(target=run_worker, name=f"bot-worker-{worker_id}")
+        process.start()
+        processes.append(process)
+    
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    
+    for process in processes:
+        process.join()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WORKERS > 1:
+        run_workers()
+    else:
+        run_worker()
@@ -0,0 +1,518 @@
+"""Нагрузочный тест Digi Store Bot.
+
+Поднимает локальные заглушки Telegram Bot API и Crypto Pay API, импортирует goving.py
+с настройками на них и прогоняет синтетические сценарии пользователей через
+dp.feed_update — те же middleware и хендлеры, что и в бою:
+
+    crypto: /start → buy_stars → получатель → количество → crypto_pay → check_crypto
+    card:   /start → buy_stars → получатель → количество → card_pay → confirm_paid → фото
+    admin:  /admin → активные заказы → следующая страница → статистика бота
+
+С --webhook апдейты вместо этого отправляются POST-запросами на WEBHOOK_PATH
+приложения create_web_app() с заголовком X-Telegram-Bot-Api-Secret-Token — в замер
+попадают HTTP-сервер, разбор JSON и проверка секрета. Ответ на запрос приходит после
+обработки апдейта, чтобы сценарий видел ответ бота перед следующим шагом.
+
+Результат (p50/p95/p99 задержки хендлеров, апдейтов в секунду, запросов к БД)
+дописывается строкой в loadtest_results.jsonl и сравнивается с прошлым запуском
+с теми же параметрами.
+
+    python loadtest.py --users 50 --duration 30
+    python loadtest.py --users 200 --api-latency 30 --label "после индексов"
+    python loadtest.py --webhook --users 50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from aiohttp import ClientSession, TCPConnector, web
+
+FAKE_BOT_TOKEN = "123456:LOADTEST-fake-token"
+SCENARIOS = ("crypto", "card", "admin")
+RESULTS_PATH = "loadtest_results.jsonl"
+
+
+# ========== ЗАГЛУШКА TELEGRAM BOT API ==========
+class FakeTelegram:
+    """Отвечает на методы Bot API как настоящий сервер; запоминает последнюю клавиатуру в каждом чате,
+    чтобы виртуальный пользователь мог «нажать» на кнопку из ответа бота"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.keyboards = {}
+        self.message_ids = itertools.count(1000)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        if "reply_markup" in params and chat_id is not None:
+            markup = params["reply_markup"]
+            self.keyboards[int(chat_id)] = json.loads(markup) if isinstance(markup, str) else markup
+
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            result = {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"},
+                "text": params.get("text", "")
+            }
+        elif method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "Load"}
+            result = {"status": "member", "user": user}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def find_button(self, chat_id, prefix, text=None):
+        markup = self.keyboards.get(chat_id) or {}
+        for row in markup.get("inline_keyboard", []):
+            for button in row:
+                data = button.get("callback_data") or ""
+                if data.startswith(prefix) and (text is None or text in button.get("text", "")):
+                    return data
+        return None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+# ========== ЗАГЛУШКА CRYPTO PAY API ==========
+class FakeCryptoPay:
+    """createInvoice выдаёт новый счёт, getInvoices отдаёт счета оплаченными (доля — paid_ratio), курс USDT/RUB фиксирован"""
+
+    def __init__(self, latency=0.0, paid_ratio=1.0):
+        self.latency = latency
+        self.paid_ratio = paid_ratio
+        self.calls = Counter()
+        self.invoices = {}
+        self.invoice_ids = itertools.count(1)
+
+    async def create_invoice(self, request):
+        self.calls["createInvoice"] += 1
+        data = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        invoice_id = next(self.invoice_ids)
+        invoice = {
+            "invoice_id": invoice_id,
+            "status": "paid" if random.random() < self.paid_ratio else "active",
+            "asset": data.get("asset", "USDT"),
+            "amount": data.get("amount"),
+            "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            "payload": data.get("payload")
+        }
+        self.invoices[str(invoice_id)] = invoice
+        return web.json_response({"ok": True, "result": invoice})
+
+    async def get_invoices(self, request):
+        self.calls["getInvoices"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        ids = [i for i in request.query.get("invoice_ids", "").split(",") if i]
+        items = [self.invoices[i] for i in ids if i in self.invoices]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+    async def get_exchange_rates(self, request):
+        self.calls["getExchangeRates"] += 1
+        return web.json_response({"ok": True, "result": [
+            {"is_valid": True, "is_crypto": True, "is_fiat": False, "source": "USDT", "target": "RUB", "rate": "85.0"}
+        ]})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/createInvoice", self.create_invoice)
+        app.router.add_get("/api/getInvoices", self.get_invoices)
+        app.router.add_get("/api/getExchangeRates", self.get_exchange_rates)
+        return app
+
+
+async def start_site(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# ========== СЧЁТЧИК ЗАПРОСОВ К БД ==========
+class QueryCounter:
+    """Считает SQL-операторы на всех соединениях Database через sqlite3 trace callback"""
+
+    def __init__(self, database):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._traced = set()
+        self._connection = database._connection
+        database._connection = self.connection
+
+    def connection(self, readonly=False):
+        conn = self._connection(readonly)
+        if id(conn) not in self._traced:
+            self._traced.add(id(conn))
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    def trace(self, statement):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        with self._lock:
+            self.counts[verb] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+
+# ========== СЦЕНАРИИ ==========
+class LoadTest:
+    def __init__(self, goving, telegram, args, webhook_url=None, session=None):
+        self.goving = goving
+        self.telegram = telegram
+        self.args = args
+        self.webhook_url = webhook_url
+        self.session = session
+        self.ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.journeys = Counter()
+        self.updates = 0
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+    def message_update(self, user_id, text=None, photo=False):
+        message = {
+            "message_id": next(self.ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id)
+        }
+        if photo:
+            message["photo"] = [{"file_id": f"photo{user_id}", "file_unique_id": f"u{user_id}", "width": 800, "height": 600}]
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self.goving.types.Update(update_id=next(self.ids), message=message)
+
+    def callback_update(self, user_id, data):
+        return self.goving.types.Update(update_id=next(self.ids), callback_query={
+            "id": str(next(self.ids)),
+            "from": self.user(user_id),
+            "chat_instance": "loadtest",
+            "data": data,
+            "message": {
+                "message_id": next(self.ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "…"
+            }
+        })
+
+    async def post_update(self, update):
+        async with self.session.post(
+            self.webhook_url,
+            data=update.model_dump_json(exclude_none=True),
+            headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": self.goving.WEBHOOK_SECRET
+            }
+        ) as response:
+            await response.read()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+
+    async def feed(self, step, update):
+        started = time.perf_counter()
+        try:
+            if self.webhook_url:
+                await self.post_update(update)
+            else:
+                await self.goving.dp.feed_update(self.goving.bot, update)
+        except Exception as e:
+            self.errors[f"{step}: {type(e).__name__}"] += 1
+        self.latencies[step].append(time.perf_counter() - started)
+        self.updates += 1
+
+    def action_prefix(self, action):
+        route = self.goving.CALLBACK_ACTIONS[action]
+        return f"{self.goving.CALLBACK_VERSION}|{route.code}|"
+
+    async def order_button(self, user_id, action):
+        data = self.telegram.find_button(user_id, self.action_prefix(action))
+        if data is None:
+            self.errors[f"нет кнопки {action}"] += 1
+        return data
+
+    async def buy_stars(self, user_id):
+        await self.feed("start", self.message_update(user_id, "/start"))
+        await self.feed("buy_stars", self.callback_update(user_id, self.goving.cb("buy_stars")))
+        await self.feed("recipient", self.message_update(user_id, f"@load{user_id}"))
+        await self.feed("stars_amount", self.message_update(user_id, str(random.randint(50, 5000))))
+
+    async def crypto_journey(self, user_id):
+        await self.buy_stars(user_id)
+        data = await self.order_button(user_id, "crypto_pay")
+        if data is None:
+            return
+        await self.feed("crypto_pay", self.callback_update(user_id, data))
+        check = await self.order_button(user_id, "check_crypto")
+        if check is None:
+            return
+        await self.feed("check_crypto", self.callback_update(user_id, check))
+
+    async def card_journey(self, user_id):
+        await self.buy_stars(user_id)
+        data = await self.order_button(user_id, "card_pay")
+        if data is None:
+            return
+        await self.feed("card_pay", self.callback_update(user_id, data))
+        confirm = await self.order_button(user_id, "confirm_paid")
+        if confirm is None:
+            return
+        await self.feed("confirm_paid", self.callback_update(user_id, confirm))
+        await self.feed("payment_photo", self.message_update(user_id, photo=True))
+
+    async def admin_journey(self, user_id):
+        admin_id = self.goving.ADMIN_IDS[0]
+        await self.feed("admin", self.message_update(admin_id, "/admin"))
+        await self.feed("active_orders", self.callback_update(admin_id, self.goving.cb("admin_active_orders")))
+        next_page = self.telegram.find_button(admin_id, self.action_prefix("orders_page"), text="Вперед")
+        if next_page:
+            await self.feed("active_orders_page", self.callback_update(admin_id, next_page))
+        await self.feed("bot_stats", self.callback_update(admin_id, self.goving.cb("admin_bot_stats")))
+
+    async def virtual_user(self, user_id, deadline):
+        journeys = {"crypto": self.crypto_journey, "card": self.card_journey, "admin": self.admin_journey}
+        weights = [self.args.crypto_weight, self.args.card_weight, self.args.admin_weight]
+        while time.monotonic() < deadline:
+            scenario = random.choices(SCENARIOS, weights)[0]
+            await journeys[scenario](user_id)
+            self.journeys[scenario] += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3) if values else 0.0
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def load_previous(path, config):
+    """Последний сохранённый результат с теми же параметрами прогона"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding="utf-8") as results_file:
+        for line in results_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("config") == config:
+                previous = record
+    return previous
+
+
+def print_report(result, previous):
+    overall = result["latency"]["overall"]
+    print("=" * 60)
+    print(f"Апдейтов: {result['updates']} за {result['elapsed_s']} с — {result['updates_per_s']} апд/с")
+    print(f"Сценариев: {result['journeys']}")
+    print(f"Задержка хендлеров: p50 {overall['p50_ms']} мс, p95 {overall['p95_ms']} мс, p99 {overall['p99_ms']} мс")
+    print(f"Запросов к БД: {result['db_queries']} ({result['db_queries_per_update']} на апдейт) {result['db_statements']}")
+    print(f"Вызовов Bot API: {result['telegram_calls']}")
+    print(f"Вызовов Crypto Pay: {result['cryptopay_calls']}")
+    if result["errors"]:
+        print(f"Ошибки: {result['errors']}")
+    print("-" * 60)
+    print(f"{'шаг':<22}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for step, summary in sorted(result["latency"].items()):
+        if step == "overall":
+            continue
+        print(f"{step:<22}{summary['count']:>7}{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}")
+
+    if previous:
+        print("-" * 60)
+        print(f"Сравнение с {previous['timestamp']} ({previous.get('revision') or '?'}"
+              f"{', ' + previous['label'] if previous.get('label') else ''}):")
+        metrics = (
+            ("updates_per_s", result["updates_per_s"], previous["updates_per_s"]),
+            ("p50_ms", overall["p50_ms"], previous["latency"]["overall"]["p50_ms"]),
+            ("p95_ms", overall["p95_ms"], previous["latency"]["overall"]["p95_ms"]),
+            ("p99_ms", overall["p99_ms"], previous["latency"]["overall"]["p99_ms"]),
+            ("db_queries_per_update", result["db_queries_per_update"], previous["db_queries_per_update"]),
+        )
+        for name, current, before in metrics:
+            change = f"{(current - before) / before * 100:+.1f}%" if before else "—"
+            print(f"  {name:<24}{before:>12} → {current:<12}{change}")
+    print("=" * 60)
+
+
+async def run(args):
+    telegram = FakeTelegram(latency=args.api_latency / 1000)
+    cryptopay = FakeCryptoPay(latency=args.api_latency / 1000, paid_ratio=args.paid_ratio)
+    telegram_runner, telegram_url = await start_site(telegram.app())
+    cryptopay_runner, cryptopay_url = await start_site(cryptopay.app())
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "BOT_TOKEN": FAKE_BOT_TOKEN,
+        "CRYPTOBOT_TOKEN": "loadtest",
+        "TELEGRAM_API_URL": telegram_url,
+        "CRYPTOBOT_API_URL": f"{cryptopay_url}/api",
+        "DB_PATH": os.path.join(workdir, "loadtest.db"),
+        "STATE_STORAGE": args.state_storage,
+        "WEBHOOK_URL": "",
+        "WORKERS": "1",
+    })
+    # Очередь уведомлений не должна ограничивать тест хендлеров, если не задано явно
+    os.environ.setdefault("NOTIFY_GLOBAL_RATE", "100000")
+    os.environ.setdefault("NOTIFY_CHAT_RATE", "100000")
+    os.environ.setdefault("CRYPTO_POLL_INTERVAL", "3600")
+    # Виртуальные пользователи нажимают кнопки чаще, чем позволяет флуд-контроль
+    os.environ.setdefault("THROTTLE_ENABLED", "0")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import goving
+    # Лог каждого апдейта от aiogram заметно искажает замеры
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    goving.create_app()
+    queries = QueryCounter(goving.db)
+    if args.webhook:
+        # startup/shutdown диспетчера вызывает само aiohttp-приложение, как в run_webhook()
+        web_app = goving.create_web_app()
+        web_app["webhook_handler"].handle_in_background = False
+        webhook_runner, webhook_url = await start_site(web_app)
+        session = ClientSession(connector=TCPConnector(limit=args.users))
+        test = LoadTest(goving, telegram, args, f"{webhook_url}{goving.WEBHOOK_PATH}", session)
+    else:
+        await goving.on_startup()
+        test = LoadTest(goving, telegram, args)
+
+    queries_before = queries.total()
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        test.virtual_user(args.first_user_id + i, deadline) for i in range(args.users)
+    ))
+    elapsed = time.monotonic() - started
+    query_counts = dict(queries.counts)
+    db_queries = queries.total() - queries_before
+
+    if args.webhook:
+        await session.close()
+        await webhook_runner.cleanup()
+    else:
+        await goving.on_shutdown()
+    await goving.close_app()
+    await telegram_runner.cleanup()
+    await cryptopay_runner.cleanup()
+
+    all_latencies = [value for values in test.latencies.values() for value in values]
+    latency = {step: latency_summary(values) for step, values in test.latencies.items()}
+    latency["overall"] = latency_summary(all_latencies)
+
+    config = {
+        "users": args.users,
+        "duration": args.duration,
+        "api_latency_ms": args.api_latency,
+        "state_storage": args.state_storage,
+        "weights": [args.crypto_weight, args.card_weight, args.admin_weight],
+    }
+    if args.webhook:
+        config["transport"] = "webhook"
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "label": args.label,
+        "config": config,
+        "elapsed_s": round(elapsed, 3),
+        "updates": test.updates,
+        "updates_per_s": round(test.updates / elapsed, 1) if elapsed else 0.0,
+        "journeys": dict(test.journeys),
+        "latency": latency,
+        "db_queries": db_queries,
+        "db_queries_per_update": round(db_queries / test.updates, 2) if test.updates else 0.0,
+        "db_statements": query_counts,
+        "telegram_calls": dict(telegram.calls),
+        "cryptopay_calls": dict(cryptopay.calls),
+        "errors": dict(test.errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Digi Store Bot на заглушках Bot API и Crypto Pay")
+    parser.add_argument("--users", type=int, default=50, help="число одновременных виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=20, help="длительность прогона, секунд")
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа заглушек API, мс")
+    parser.add_argument("--paid-ratio", type=float, default=1.0, help="доля счетов CryptoBot, которые сразу оплачены")
+    parser.add_argument("--state-storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--webhook", action="store_true", help="отправлять апдейты HTTP-запросами на вебхук, а не в dp.feed_update")
+    parser.add_argument("--crypto-weight", type=float, default=4, help="вес сценария оплаты CryptoBot")
+    parser.add_argument("--card-weight", type=float, default=4, help="вес сценария оплаты картой")
+    parser.add_argument("--admin-weight", type=float, default=1, help="вес сценария админа")
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default="", help="пометка прогона в файле результатов")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL-файл с историей прогонов")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    result = asyncio.run(run(args))
+    previous = load_previous(args.results, result["config"])
+    print_report(result, previous)
+
+    with open(args.results, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()